@@ -0,0 +1,86 @@
+"""Asynchronous directory scanner for high latency (network) filesystems.
+
+Synchronous scanning waits for every readdir, stat and read one after
+another, which on NFS or SMB mounts means a network round trip each.
+Here the blocking calls run in a bounded thread pool driven by asyncio,
+so many of them are in flight at once. Work is taken from a priority
+queue: directory listings first (to discover more work early), then
+stat calls and finally checksumming.
+"""
+import asyncio, itertools, os
+from concurrent.futures import ThreadPoolExecutor
+
+# Speed up scanning with scandir in Python 3.5 (or PIP package)
+try: from os import scandir
+except ImportError: from scandir import scandir
+
+READDIR, STAT, HASH = 0, 1, 2 # job priorities, lowest first
+
+def _listdir(path: str, skip) -> list:
+    """Return (DirEntry, is_dir) pairs of a directory, run in a thread."""
+    return [(e, e.is_dir(follow_symlinks=False)) for e in scandir(path)
+            if not skip(e)]
+
+async def _walk(directory: str, skip, describe, prepare, digest, emit,
+        workers: int) -> None:
+    loop = asyncio.get_running_loop()
+    queue = asyncio.PriorityQueue()
+    order = itertools.count() # FIFO within a priority, never compare jobs
+    errors = []
+
+    def put(prio, job, *args): queue.put_nowait((prio, next(order), job, args))
+
+    def run(func, *args): return loop.run_in_executor(pool, func, *args)
+
+    async def listdir(path):
+        for e,isdir in await run(_listdir, path, skip):
+            put(STAT, stat, e)
+            if isdir: put(READDIR, listdir, e.path)
+
+    async def stat(e):
+        f = await run(describe, e)
+        p = os.path.relpath(e.path, directory)
+        if prepare(p, f, e): put(HASH, checksum, e, p, f)
+        else: emit(p, f)
+
+    async def checksum(e, p, f):
+        await run(digest, e, f)
+        emit(p, f)
+
+    async def worker():
+        while True:
+            _, _, job, args = await queue.get()
+            try:
+                if not errors: await job(*args) # after failure just drain
+            except Exception as e: errors.append(e)
+            finally: queue.task_done()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        put(READDIR, listdir, directory)
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        try: await queue.join()
+        finally:
+            for t in tasks: t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    if errors: raise errors[0]
+
+def walk(directory: str, skip, describe, prepare, digest, emit,
+        workers: int=16) -> None:
+    """Scan directory tree concurrently, passing each entry to callbacks.
+
+    Blocking callbacks run in worker threads, the others in the calling
+    thread so they can update shared state without locking. Entries are
+    emitted in no particular order, and the first exception raised by
+    a callback or file system call stops the scan and is re-raised.
+
+    Args:
+        directory (str): Directory to scan
+        skip (callable): skip(DirEntry) returns True for entries to skip
+        describe (callable): describe(DirEntry) returns a record dict (blocking)
+        prepare (callable): prepare(relpath, record, DirEntry) returns
+            True if record needs checksumming
+        digest (callable): digest(DirEntry, record) adds checksum (blocking)
+        emit (callable): emit(relpath, record) receives finished records
+        workers (int): Maximum number of concurrent blocking calls
+    """
+    asyncio.run(_walk(directory, skip, describe, prepare, digest, emit, workers))
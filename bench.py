@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Reproducible benchmarks for Fileson hot paths.
+
+Generates synthetic file trees (many small files, few huge files, deep
+trees) into a work directory, times scenarios on them and prints results
+as JSON for regression tracking. Backup and restore run against a local
+fake S3 so no network or credentials are needed, and scanning of network
+filesystems is simulated by adding latency to directory and stat calls.
+"""
+from collections import namedtuple
+import argparse, contextlib, io, json, os, platform, random, shutil, sys
+import statistics, subprocess, tempfile, time
+
+from fileson import Fileson
+from logdict import LogDict
+from hash import sha_file
+import metrics
+
+def make_tree(root: str, kind: str, scale: float=1, seed: int=0) -> int:
+    """Create a deterministic synthetic tree, return total bytes written.
+
+    Kinds are 'small' (many small files in a flat-ish tree, every tenth
+    a duplicate), 'huge' (few large files) and 'deep' (long directory
+    chains). Scale multiplies file counts (or sizes for 'huge').
+    """
+    rnd = random.Random(seed)
+    total, last = 0, b''
+    def write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f: f.write(data)
+        return len(data)
+
+    if kind == 'small':
+        for i in range(int(5000*scale)):
+            data = last if i % 10 == 9 else rnd.randbytes(rnd.randint(1, 16*2**10))
+            total += write(os.path.join(root, f'd{i%50:02d}', f'f{i:06d}.dat'), data)
+            last = data
+    elif kind == 'huge':
+        for i in range(4):
+            path = os.path.join(root, f'huge{i}.bin')
+            os.makedirs(root, exist_ok=True)
+            with open(path, 'wb') as f:
+                for _ in range(int(16*scale)): # 16 MiB per unit of scale
+                    total += f.write(rnd.randbytes(2**20))
+    elif kind == 'deep':
+        for i in range(int(20*scale)):
+            path = os.path.join(root, *(f'l{d}' for d in range(i % 10 + 40)))
+            for j in range(5):
+                total += write(os.path.join(path, f'c{i}_{j}.txt'), rnd.randbytes(100))
+    else: raise ValueError(f'Unknown tree kind {kind}')
+    return total
+
+class FakeS3(object):
+    """Minimal boto3 S3 client stand-in storing objects in a local dir."""
+    def __init__(self, root: str) -> None: self.root = root
+
+    def _path(self, bucket, key):
+        path = os.path.join(self.root, bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def upload_fileobj(self, fp, bucket, key, Callback=None, Config=None, ExtraArgs=None):
+        with open(self._path(bucket, key), 'wb') as fout:
+            for data in iter(lambda: fp.read(2**20), b''):
+                fout.write(data)
+                if Callback: Callback(len(data))
+
+    def download_fileobj(self, bucket, key, fp, Callback=None, Config=None):
+        with open(self._path(bucket, key), 'rb') as fin:
+            for data in iter(lambda: fin.read(2**20), b''):
+                fp.write(data)
+                if Callback: Callback(len(data))
+
+    def delete_objects(self, Bucket, Delete):
+        for o in Delete['Objects']: os.unlink(self._path(Bucket, o['Key']))
+        return {}
+
+class SlowEntry(object):
+    """DirEntry wrapper adding latency to the first (uncached) stat call."""
+    def __init__(self, e, delay: float) -> None:
+        self._e, self._delay, self._stat = e, delay, None
+
+    def stat(self, **kwargs):
+        if self._stat is None:
+            time.sleep(self._delay)
+            self._stat = self._e.stat(**kwargs)
+        return self._stat
+
+    def __getattr__(self, name): return getattr(self._e, name)
+
+@contextlib.contextmanager
+def latency(delay: float):
+    """Make scandir and stat in scanners sleep delay seconds per call.
+
+    Simulates a network filesystem where each call is a round trip.
+    """
+    import ascan, fileson
+    orig = fileson.scandir
+    def slow_scandir(path):
+        time.sleep(delay)
+        return [SlowEntry(e, delay) for e in orig(path)]
+    fileson.scandir = ascan.scandir = slow_scandir
+    try: yield
+    finally: fileson.scandir = ascan.scandir = orig
+
+HEAVY = ('boto3', 'botocore', 'Crypto') # must not load just for --help
+STARTUP_BUDGET = 0.25 # seconds of imports allowed, measured 0.10-0.16s
+
+def startup(script: str) -> dict:
+    """Run script --help with -X importtime, return seconds spent importing.
+
+    Raises RuntimeError if a heavy dependency was imported. Imports taking
+    longer than :data:`STARTUP_BUDGET` are flagged with 'over_budget' in
+    the returned dict, as timings depend on the machine.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, '-X', 'importtime',
+        os.path.join(here, script), '--help'], capture_output=True, text=True,
+        check=True, cwd=here)
+    total, heavy = 0, set()
+    for l in proc.stderr.splitlines():
+        if not l.startswith('import time:') or 'cumulative' in l: continue
+        _, cumulative, name = l[12:].split('|')
+        if not name.startswith('  '): total += int(cumulative) # top level
+        if name.strip().split('.')[0] in HEAVY: heavy.add(name.strip().split('.')[0])
+    if heavy: raise RuntimeError(f'{script} --help imported {", ".join(sorted(heavy))}')
+    return {'import_seconds': total / 1e6, 'over_budget': total / 1e6 > STARTUP_BUDGET}
+
+def timed(func, repeat: int=3, setup=None) -> dict:
+    """Run func repeat times (after setup each time), return timings.
+
+    A dict returned by func on the fastest run is added to the result.
+    """
+    secs, returned = [], []
+    for _ in range(repeat):
+        if setup: setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            returned.append(func())
+            secs.append(time.perf_counter() - start)
+    res = {'seconds': secs, 'min': min(secs), 'median': statistics.median(secs)}
+    best = returned[secs.index(min(secs))]
+    if isinstance(best, dict): res.update(best)
+    return res
+
+def scenarios(work: str, scale: float) -> dict:
+    """Return dict of scenario name to (function, setup, bytes) tuples."""
+    trees = {k: os.path.join(work, k) for k in ('small', 'huge', 'deep')}
+    sizes = {k: make_tree(p, k, scale) for k,p in trees.items()}
+    db = os.path.join(work, 'small.fson')
+    Fileson.load_or_scan(trees['small'], checksum='sha1').save(db)
+    huge = os.path.join(trees['huge'], 'huge0.bin')
+    hugesize = os.path.getsize(huge)
+    key = bytes(range(32))
+
+    def scan_cold(kind):
+        def run(): Fileson().scan(trees[kind], checksum='sha1')
+        return run
+    cache = os.path.join(work, 'checksums.sqlite')
+    Fileson().scan(trees['small'], checksum='sha1', cache=cache)
+    def scan_cached():
+        Fileson().scan(trees['small'], checksum='sha1', cache=cache)
+    def scan_warm():
+        fs = Fileson.load(db)
+        fs.scan(trees['small'], checksum='sha1')
+
+    def scan_latency(scanner):
+        def run():
+            with latency(0.001):
+                Fileson().scan(trees['small'], scanner=scanner)
+        return run
+
+    res = {
+        'scan_cold_small': (scan_cold('small'), None, sizes['small']),
+        'scan_cold_deep': (scan_cold('deep'), None, sizes['deep']),
+        'scan_cold_huge': (scan_cold('huge'), None, sizes['huge']),
+        'scan_warm_small': (scan_warm, None, sizes['small']),
+        'scan_cached_small': (scan_cached, None, sizes['small']),
+        'scan_latency_sync': (scan_latency('sync'), None, sizes['small']),
+        'scan_latency_async': (scan_latency('async'), None, sizes['small']),
+        'logdict_load': (lambda: LogDict.load(db), None, os.path.getsize(db)),
+        'sha_file': (lambda: sha_file(huge), None, hugesize),
+    }
+
+    import fileson_util
+    dupargs = namedtuple('myargs', 'dbs_or_dirs minsize checksum cache processes partitions sortmem verbose')
+    res['duplicates'] = (lambda: fileson_util.duplicates(
+        dupargs([db], '0', 'sha1', None, 1, 64, None, 0)), None, os.path.getsize(db))
+    diffargs = namedtuple('myargs', 'src dest delta cache')
+    res['diff'] = (lambda: fileson_util.diff(
+        diffargs(db, trees['small'], io.StringIO(), cache)),
+        None, sizes['small'])
+
+    for tool in ('fileson_util', 'fileson_backup', 'fileson_tool'):
+        res[f'startup_{tool[8:]}'] = (lambda tool=tool: startup(tool + '.py'), None, 0)
+
+    try:
+        import boto3, fileson_backup, mycrypt
+        mycrypt._aes() # pycryptodome is imported lazily
+    except ImportError as e: # no boto3 or pycryptodome, skip the rest
+        print('Skipping crypto and backup scenarios:', e, file=sys.stderr)
+        return res
+
+    def encrypt():
+        with mycrypt.AESFile(huge, 'rb', key) as fin:
+            for _ in iter(lambda: fin.read(2**20), b''): pass
+    enc = os.path.join(work, 'huge.enc')
+    with mycrypt.AESFile(huge, 'rb', key) as fin, open(enc, 'wb') as fout:
+        shutil.copyfileobj(fin, fout)
+    def decrypt():
+        with open(enc, 'rb') as fin, \
+                mycrypt.AESFile(os.path.join(work, 'huge.dec'), 'wb', key) as fout:
+            shutil.copyfileobj(fin, fout)
+    def etag():
+        with open(huge, 'rb') as fin: mycrypt.calc_etag(fin)
+    res['aes_encrypt'] = (encrypt, None, hugesize)
+    res['aes_decrypt'] = (decrypt, None, hugesize)
+    res['calc_etag'] = (etag, None, hugesize)
+
+    # Backup to and restore from fake S3 with encryption
+    s3root, log = os.path.join(work, 's3'), os.path.join(work, 'small.log')
+    restored, keyfile = os.path.join(work, 'restored'), key.hex()
+    def clean():
+        for p in (s3root, restored):
+            if os.path.exists(p): shutil.rmtree(p)
+        if os.path.exists(log): os.remove(log)
+        fileson_backup._s3 = FakeS3(s3root)
+    bargs = namedtuple('myargs', 'dbfile logfile destination keyfile deep_archive index bwlimit concurrency simulate verbose')
+    backup = lambda: fileson_backup.backup(bargs(db, log,
+        's3://bucket/bench', keyfile, False, None, None, 'auto', False, 0))
+    rargs = namedtuple('myargs', 'dbfile logfile source destination paths keyfile jobs verbose simulate')
+    restore = lambda: fileson_backup.restore(rargs(db, log,
+        os.path.join(s3root, 'bucket', 'bench'), restored, [], keyfile, 16, 0, False))
+    def restore_setup():
+        clean()
+        with contextlib.redirect_stdout(io.StringIO()): backup()
+    res['backup'] = (backup, clean, sizes['small'])
+    res['restore'] = (restore, restore_setup, sizes['small'])
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description='Fileson benchmarks')
+    parser.add_argument('scenario', nargs='*', help='Scenarios to run (default all)')
+    parser.add_argument('-s', '--scale', type=float, default=1,
+        help='Synthetic tree size multiplier (default 1)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='Repeats per scenario, min and median reported (default 3)')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+        default='-', help='JSON output file or - for stdout (default)')
+    parser.add_argument('-w', '--workdir', type=str, default=None,
+        help='Directory for synthetic trees (default temporary)')
+    parser.add_argument('--profile', type=str, default=None,
+        help='Profile scenarios and dump pstats to this file')
+    args = parser.parse_args()
+
+    work = args.workdir or tempfile.mkdtemp(prefix='fileson-bench-')
+    try:
+        cases = scenarios(work, args.scale)
+        results = {}
+        def run(_=None):
+            for name,(func, setup, nbytes) in cases.items():
+                if args.scenario and not name in args.scenario: continue
+                results[name] = timed(func, args.repeat, setup)
+                results[name]['bytes'] = nbytes
+                results[name]['MiB/s'] = nbytes / 2**20 / results[name]['min']
+                print(f'{name}: {results[name]["min"]:.3f}s', file=sys.stderr)
+                if results[name].get('over_budget', False):
+                    print(f'{name}: imports took {results[name]["import_seconds"]:.3f}s,',
+                            f'over budget {STARTUP_BUDGET}s', file=sys.stderr)
+        if args.profile: metrics.profile(run, None, args.profile)
+        else: run()
+    finally:
+        if not args.workdir: shutil.rmtree(work)
+
+    json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+        'scale': args.scale, 'repeat': args.repeat, 'results': results},
+        args.output, indent=2)
+    args.output.write('\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Persistent checksum cache shared by scans of any database."""
+import os, sqlite3, threading, time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS inode (dev INTEGER, ino INTEGER, size INTEGER,
+    mtime_ns INTEGER, type TEXT, value TEXT, used REAL,
+    PRIMARY KEY (dev, ino, size, mtime_ns, type));
+CREATE TABLE IF NOT EXISTS path (path TEXT, size INTEGER, mtime_ns INTEGER,
+    type TEXT, value TEXT, used REAL,
+    PRIMARY KEY (path, size, mtime_ns, type));
+CREATE INDEX IF NOT EXISTS inode_used ON inode (used);
+CREATE INDEX IF NOT EXISTS path_used ON path (used);
+'''
+
+class ChecksumCache(object):
+    """Size-bounded SQLite cache of file checksums with LRU eviction.
+
+    Checksums are stored by (device, inode, size, mtime_ns) so they stay
+    valid however the file is reached, and by (path, size, mtime_ns) for
+    filesystems where device or inode numbers are not stable. Either key
+    matching is a hit. Writes are batched and least recently used entries
+    evicted on :meth:`close`. Thread-safe.
+
+    Args:
+        filename (str): SQLite database, created if it does not exist
+        maxsize (int): Maximum number of entries (per key kind)
+        bypath (bool): Also store and look up by path
+    """
+    def __init__(self, filename: str, maxsize: int=4*10**6,
+            bypath: bool=True) -> None:
+        self.filename, self.maxsize, self.bypath = filename, maxsize, bypath
+        self.hits = self.misses = 0
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._touched, self._pending = [], 0
+        self._now = time.time()
+
+    def _keys(self, path: str, st: os.stat_result) -> tuple:
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns), \
+                (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    def get(self, path: str, st: os.stat_result, kind: str) -> str:
+        """Return cached checksum of given type for file, or None."""
+        ikey, pkey = self._keys(path, st)
+        with self._lock:
+            row = self._db.execute('SELECT value FROM inode WHERE dev=? AND ' +
+                    'ino=? AND size=? AND mtime_ns=? AND type=?', ikey + (kind,)).fetchone()
+            if row is None and self.bypath:
+                row = self._db.execute('SELECT value FROM path WHERE path=? AND ' +
+                        'size=? AND mtime_ns=? AND type=?', pkey + (kind,)).fetchone()
+                if row: self._put(ikey, pkey, kind, row[0]) # inode changed
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched.append((ikey + (kind,), pkey + (kind,)))
+            self._pending += 1
+            if self._pending >= 1000: self._commit()
+            return row[0]
+
+    def _put(self, ikey, pkey, kind, value):
+        self._db.execute('INSERT OR REPLACE INTO inode VALUES (?,?,?,?,?,?,?)',
+                ikey + (kind, value, self._now))
+        if self.bypath:
+            self._db.execute('INSERT OR REPLACE INTO path VALUES (?,?,?,?,?,?)',
+                    pkey + (kind, value, self._now))
+        self._pending += 1
+        if self._pending >= 1000: self._commit()
+
+    def put(self, path: str, st: os.stat_result, kind: str, value: str) -> None:
+        """Store checksum of given type for file."""
+        if not value: return
+        with self._lock: self._put(*self._keys(path, st), kind, value)
+
+    def _commit(self):
+        self._db.executemany('UPDATE inode SET used=? WHERE dev=? AND ino=? ' +
+                'AND size=? AND mtime_ns=? AND type=?',
+                ((self._now,) + k for k,_ in self._touched))
+        if self.bypath:
+            self._db.executemany('UPDATE path SET used=? WHERE path=? AND ' +
+                    'size=? AND mtime_ns=? AND type=?',
+                    ((self._now,) + k for _,k in self._touched))
+        self._db.commit()
+        self._touched, self._pending = [], 0
+
+    def evict(self) -> int:
+        """Remove least recently used entries over maxsize, return count."""
+        removed = 0
+        with self._lock:
+            self._commit()
+            for table in ('inode', 'path'):
+                n = self._db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                if n <= self.maxsize: continue
+                removed += self._db.execute(f'DELETE FROM {table} WHERE rowid IN ' +
+                        f'(SELECT rowid FROM {table} ORDER BY used LIMIT ?)',
+                        (n - self.maxsize,)).rowcount
+            self._db.commit()
+        return removed
+
+    def close(self) -> None:
+        """Save pending changes, evict and close the database."""
+        self.evict()
+        self._db.close()
+
+    def __enter__(self) -> 'ChecksumCache': return self
+
+    def __exit__(self, type, value, traceback) -> None: self.close()
@@ -0,0 +1,75 @@
+"""External merge sort for key sets too large to sort in memory.
+
+Items are collected into memory until their estimated size reaches the
+budget, then sorted and spilled as a run of JSON lines into a temporary
+file. Runs are k-way merged (in several passes if there are very many of
+them). Below the budget this is just an in-memory sort.
+"""
+import heapq, itertools, json, sys, tempfile
+
+MEMORY = 512 # default budget in megabytes
+FANIN = 64 # maximum number of runs merged at once
+
+def _size(x) -> int:
+    """Rough memory use of an item and its direct members."""
+    n = sys.getsizeof(x)
+    if isinstance(x, (tuple, list)): n += sum(sys.getsizeof(y) for y in x)
+    return n
+
+def _spill(items, dumps) -> 'file':
+    f = tempfile.TemporaryFile('w+', encoding='utf8')
+    for x in items:
+        f.write(dumps(x))
+        f.write('\n')
+    f.seek(0)
+    return f
+
+def _read(f, loads):
+    for l in f: yield loads(l)
+
+def sort(iterable, key=None, memory: int=None, dumps=json.dumps,
+        loads=json.loads):
+    """Yield items of iterable in sorted order, spilling to disk if needed.
+
+    Spilled items go through dumps and loads, so they need to survive a
+    JSON round trip (tuples come back as lists, mappings as dicts), and
+    key must give the same result for both.
+
+    Args:
+        iterable: Items to sort
+        key (callable): Sort key like in :func:`sorted`
+        memory (int): Budget in megabytes, default :data:`MEMORY`
+        dumps (callable): Serialize item to a single line string
+        loads (callable): Deserialize item from a line
+    """
+    budget = (memory or MEMORY) * 2**20
+    buf, used, runs = [], 0, []
+    try:
+        for x in iterable:
+            buf.append(x)
+            used += _size(x)
+            if used >= budget:
+                buf.sort(key=key)
+                runs.append(_spill(buf, dumps))
+                buf, used = [], 0
+        buf.sort(key=key)
+        if not runs:
+            yield from buf
+            return
+        if buf: runs.append(_spill(buf, dumps))
+        del buf
+
+        while len(runs) > FANIN: # merge passes to limit open files, keeping order
+            groups, runs = [runs[i:i+FANIN] for i in range(0, len(runs), FANIN)], []
+            for group in groups:
+                runs.append(_spill(heapq.merge(*(_read(f, loads) for f in group),
+                    key=key), dumps))
+                for f in group: f.close()
+        yield from heapq.merge(*(_read(f, loads) for f in runs), key=key)
+    finally:
+        for f in runs: f.close()
+
+def groupby(iterable, key, memory: int=None, dumps=json.dumps, loads=json.loads):
+    """Sort iterable externally by key and yield (key, list of items) groups."""
+    for k,g in itertools.groupby(sort(iterable, key, memory, dumps, loads), key):
+        yield k, list(g)
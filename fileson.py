@@ -1,23 +1,70 @@
 """Fileson class to manipulate Fileson databases."""
-import json, os, time, re
+import json, os, time, re, calendar, stat
+from collections.abc import Mapping
 from datetime import datetime
 from typing import Any, Tuple, Generator
 
 from logdict import LogDict
+from pathindex import PathIndex
 from hash import sha_file
+from skip import SkipMatcher
+from csumcache import ChecksumCache
+import metrics
 
 # Speed up scanning with scandir in Python 3.5 (or PIP package)
 try: from os import scandir
 except ImportError: from scandir import scandir
 
-def scantree(path, skip=lambda x: False):
-    """Recursively yield DirEntry objects for given directory."""
+def scantree(path, skip=lambda e: False):
+    """Recursively yield DirEntry objects for given directory.
+
+    Entries for which skip(DirEntry) is True are left out (and not
+    descended into), see :class:`skip.SkipMatcher`.
+    """
     for e in scandir(path):
-        if skip(e.path): continue
+        if skip(e): continue
         yield e # the entry itself
         if e.is_dir(follow_symlinks=False):
             yield from scantree(e.path, skip)
 
+class PathEntry(object):
+    """DirEntry lookalike for a single path, raises OSError if missing."""
+    def __init__(self, path: str) -> None:
+        self.path, self.name = path, os.path.basename(path)
+        self._lstat = os.lstat(path)
+
+    def is_symlink(self) -> bool: return stat.S_ISLNK(self._lstat.st_mode)
+
+    def is_dir(self, follow_symlinks: bool=True) -> bool:
+        return stat.S_ISDIR(self.stat(follow_symlinks=follow_symlinks).st_mode)
+
+    def stat(self, follow_symlinks: bool=True) -> os.stat_result:
+        if follow_symlinks and self.is_symlink(): return os.stat(self.path)
+        return self._lstat
+
+    def inode(self) -> int: return self._lstat.st_ino
+
+def entry_record(e, directory: str) -> dict:
+    """Return record (without checksum) for a DirEntry under directory."""
+    with metrics.timer('scan_stat_seconds', 'Latency of stat calls'):
+        st = e.stat() # cached by DirEntry for the calls below
+    if e.is_symlink(): # get relative path to target
+        relative = os.path.relpath(os.readlink(e.path), directory)
+        return { 'link': relative, 'modified_gmt': gmt_str(st.st_mtime),
+                'permissions': st.st_mode }
+    elif e.is_dir(follow_symlinks=False):
+        return { 'modified_gmt': gmt_str(st.st_mtime), 'permissions': st.st_mode }
+    else: # should be a file, hard links get an id in Fileson.scan
+        f = { 'size': st.st_size, 'modified_gmt': gmt_str(st.st_mtime),
+                'permissions': st.st_mode }
+        if st.st_nlink > 1: f['hardlink'] = (st.st_dev, st.st_ino)
+        return f
+
+scan_files = metrics.counter('scan_files', 'Files scanned')
+scan_dirs = metrics.counter('scan_dirs', 'Directories scanned')
+scan_bytes = metrics.counter('scan_bytes', 'Bytes in files scanned')
+hash_bytes = metrics.counter('hash_bytes', 'Bytes checksummed')
+
 def gmt_str(mtime: int=None) -> str:
     """Convert st_mtime to GMT string."""
     return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(mtime))
@@ -27,6 +74,94 @@ def gmt_epoch(mtime: str) -> int:
     utc_time = datetime.strptime(mtime, '%Y-%m-%d %H:%M:%S')
     return int((utc_time - datetime(1970, 1, 1)).total_seconds())
 
+_days = {} # epoch of each YYYY-MM-DD seen, they repeat a lot
+
+def _fast_epoch(s: str) -> int:
+    """Parse YYYY-MM-DD HH:MM:SS to epoch, ValueError unless canonical."""
+    day = _days.get(s[:10])
+    if day is None:
+        day = calendar.timegm(time.strptime(s[:10], '%Y-%m-%d'))
+        if gmt_str(day)[:10] != s[:10]: raise ValueError(f'Not canonical: {s}')
+        _days[s[:10]] = day
+    h, m, sec = int(s[11:13]), int(s[14:16]), int(s[17:19])
+    if not (0 <= h < 24 and 0 <= m < 60 and 0 <= sec < 60) or \
+            ' %02d:%02d:%02d' % (h, m, sec) != s[10:]:
+        raise ValueError(f'Not canonical: {s}')
+    return day + 3600*h + 60*m + sec
+
+_modes = {}
+
+class Entry(Mapping):
+    """Compact read-only file/dir record with a dict-compatible interface.
+
+    Size and permissions are stored as ints, modified_gmt as epoch and a
+    sha1 hex digest as 20 bytes, anything else (or not in canonical form)
+    in an extra dict. Reading returns the original values, and comparison
+    with a dict works as expected. Use dict(e) for a real dict, that is
+    also what JSON serialization via :class:`LogDict` does.
+    """
+    __slots__ = ('size', 'mtime', 'mode', 'digest', 'extra')
+
+    @classmethod
+    def pack(cls, d: dict) -> 'Entry':
+        """Create an Entry from a dict."""
+        e = cls.__new__(cls)
+        e.size = e.mtime = e.mode = e.digest = None
+        extra = {}
+        for k,v in d.items():
+            if k == 'size' and type(v) is int:
+                e.size = v
+                continue
+            if k == 'permissions' and type(v) is int:
+                e.mode = _modes.setdefault(v, v) # share the few distinct ints
+                continue
+            if k == 'modified_gmt' and isinstance(v, str) and len(v) == 19:
+                try:
+                    e.mtime = _fast_epoch(v)
+                    continue
+                except ValueError: pass
+            if k == 'sha1' and isinstance(v, str) and len(v) == 40:
+                try: digest = bytes.fromhex(v)
+                except ValueError: digest = None
+                if digest and digest.hex() == v:
+                    e.digest = digest
+                    continue
+            extra[k] = v # anything else stored as is
+        e.extra = extra or None
+        return e
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'size' and self.size is not None: return self.size
+        if key == 'modified_gmt' and self.mtime is not None: return gmt_str(self.mtime)
+        if key == 'permissions' and self.mode is not None: return self.mode
+        if key == 'sha1' and self.digest is not None: return self.digest.hex()
+        if self.extra is not None and key in self.extra: return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        if key == 'size' and self.size is not None: return True
+        if key == 'modified_gmt' and self.mtime is not None: return True
+        if key == 'permissions' and self.mode is not None: return True
+        if key == 'sha1' and self.digest is not None: return True
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        if self.size is not None: yield 'size'
+        if self.mtime is not None: yield 'modified_gmt'
+        if self.mode is not None: yield 'permissions'
+        if self.digest is not None: yield 'sha1'
+        if self.extra is not None: yield from self.extra
+
+    def __len__(self) -> int: return sum(1 for _ in self)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Mapping): return NotImplemented
+        return dict(self) == dict(other)
+
+    __hash__ = None
+
+    def __repr__(self) -> str: return repr(dict(self))
+
 class Fileson(LogDict):
     """File database with previous versions support based on LogDict.
 
@@ -38,9 +173,9 @@ class Fileson(LogDict):
     """
 
     summer = {
-            'none': lambda p,f: None,
-            'sha1': lambda p,f: sha_file(p),
-            'sha1fast': lambda p,f: sha_file(p, quick=True)+str(f['size']),
+            'none': lambda p,f,**kw: None,
+            'sha1': lambda p,f,**kw: sha_file(p, **kw),
+            'sha1fast': lambda p,f,**kw: sha_file(p, quick=True, **kw)+str(f['size']),
             }
 
     @classmethod
@@ -62,22 +197,191 @@ class Fileson(LogDict):
             return fs
         else: return cls.load(db_or_dir)
 
+    @staticmethod
+    def history(dbfile: str) -> Tuple[str, int]:
+        """Split f.fson~1 history syntax to filename and steps back (or 0)."""
+        m = re.match(r'(.*)~(\d+)', dbfile)
+        return (m.group(1), int(m.group(2))) if m else (dbfile, 0)
+
+    @staticmethod
+    def scan_summary(dbfile: str) -> Tuple[int, int, dict]:
+        """Return (log entries, scan, :stats: or None) of a version.
+
+        Supports f.fson~1 history syntax. Only metadata lines are decoded,
+        so this is fast for any version of a large database. :scrub:
+        records are not counted as entries.
+        """
+        dbfile, back = Fileson.history(dbfile)
+        if not os.path.exists(dbfile): return 0, 0, None
+        ends, stats, scan, n = {}, {}, 0, 0 # ends: entries up to end of scan
+        with open(dbfile, 'r', encoding='utf8') as fin:
+            for l in fin:
+                if l.startswith('[":scan:",'):
+                    ends[scan], scan = n, json.loads(l)[1]
+                elif l.startswith('[":stats:",'):
+                    t = json.loads(l)
+                    stats[t[1].get('scan', None)] = t[1]
+                elif l.startswith('[":scrub:",'): continue
+                n += 1
+        ends[scan] = n
+        version = max(scan - back, 0)
+        return ends.get(version, 0), version, stats.get(version, None)
+
+    @staticmethod
+    def compact(dbfile: str, outfile: str, keep: int=10,
+            monthly: bool=False) -> Tuple[list, int, int]:
+        """Write a compacted log with only the state at retained versions.
+
+        Versions are scans (or backup runs in a backup log). The last keep
+        ones are retained, and with monthly also the last one of each
+        month. Changes between retained versions are collapsed into one
+        set or delete per key, and versions renumbered consecutively, so
+        f.fson~N still works and gives the same state for the last keep
+        versions. A :stats: record is dropped if its version absorbed
+        dropped ones (use :meth:`restat` to rebuild). The log is streamed,
+        only the keys present and changes since the last retained version
+        are kept in memory. Blobs in backup logs stay after the
+        :destination: they were written to.
+
+        Args:
+            dbfile (str): Database (or backup log) to read
+            outfile (str): File to write
+            keep (int): Number of latest versions to retain
+            monthly (bool): Retain last version of every month as well
+
+        Returns:
+            tuple: (retained versions as original numbers, lines in, lines out)
+        """
+        marker, versions, version = None, {}, 0
+        with open(dbfile, 'r', encoding='utf8') as fin:
+            for l in fin: # metadata only in first pass
+                if not l.startswith('[":'): continue
+                t = json.loads(l)
+                if len(t) < 2: continue
+                if marker is None and t[0] in (':scan:', ':backup:'): marker = t[0]
+                if t[0] == marker:
+                    version = t[1]
+                    versions.setdefault(version, '')
+                elif t[0] == ':date_gmt:' and marker: versions[version] = t[1]
+
+        order = list(versions)
+        retained = set(order[-keep:] if keep > 0 else order[-1:])
+        if monthly:
+            months = {}
+            for v in order: months[versions[v][:7]] = v
+            retained.update(months.values())
+        renumber = {v: i+1 for i,v in enumerate(v for v in order if v in retained)}
+
+        exists, meta, pending = set(), {}, {}
+        state = {'dest': None, 'spanned': 0, 'in': 0, 'out': 0}
+        with open(dbfile, 'r', encoding='utf8') as fin, \
+                open(outfile, 'w', encoding='utf8') as fout:
+            def write(t):
+                fout.write(t if isinstance(t, str) else json.dumps(t) + '\n')
+                state['out'] += 1
+
+            def flush(v):
+                write([marker, renumber[v]])
+                for k,val in meta.items():
+                    if k == ':destination:': continue # written along with blobs
+                    if k == ':stats:':
+                        if state['spanned'] > 1: continue # stale
+                        if isinstance(val, dict) and 'scan' in val:
+                            val = dict(val, scan=renumber[v])
+                    write([k, val])
+                for ctx in dict.fromkeys(c for _,c in pending.values()):
+                    if ctx is not None and ctx != state['dest']:
+                        write([':destination:', ctx])
+                        state['dest'] = ctx
+                    for k,(l,c) in pending.items():
+                        if c != ctx: continue
+                        if l is None: # deletion
+                            if k not in exists: continue # created in between
+                            write([k])
+                            exists.discard(k)
+                        else:
+                            write(l)
+                            exists.add(k)
+                dest = meta.get(':destination:', state['dest'])
+                if dest != state['dest']:
+                    write([':destination:', dest])
+                    state['dest'] = dest
+                meta.clear()
+                pending.clear()
+                state['spanned'] = 0
+
+            version, ctx = 0, None
+            for l in fin:
+                state['in'] += 1
+                t = json.loads(l)
+                k = t[0]
+                if k == marker and len(t) == 2:
+                    if version in retained: flush(version)
+                    version = t[1]
+                    state['spanned'] += 1
+                elif k[:1] == ':':
+                    if len(t) < 2: meta.pop(k, None)
+                    else:
+                        meta[k] = t[1]
+                        if k == ':destination:': ctx = t[1]
+                else: pending[k] = (l if len(t) == 2 else None, ctx)
+            if version in retained: flush(version)
+            if marker is None: # no versions at all, just the current state
+                for k,val in meta.items(): write([k, val])
+                for k,(l,c) in pending.items():
+                    if l is not None: write(l)
+        return sorted(retained), state['in'], state['out']
+
     @classmethod
     def load(cls: 'Fileson', dbfile: str) -> 'Fileson':
         """Overloaded class method to support f.fson~1 history syntax."""
-        m = re.match(r'(.*)~(\d+)', dbfile)
-        if m: dbfile = m.group(1)
+        dbfile, back = cls.history(dbfile)
         fs = super(Fileson, cls).load(dbfile)
-        if m: end = (':scan:', fs[':scan:'] - int(m.group(2)) + 1)
-        return fs.slice(None, end) if m else fs
+        if back > fs.get(':scan:', 0):
+            raise ValueError(f'{dbfile} has {fs.get(":scan:", 0)} scans, cannot go {back} back')
+        if back: end = (':scan:', fs[':scan:'] - back + 1)
+        return fs.slice(None, end) if back else fs
+
+    _index = None # PathIndex, built on first use
+
+    @staticmethod
+    def _size(value: Any) -> int:
+        """Return size of a file entry, None for dirs (and other values)."""
+        return value.get('size', None) if isinstance(value, Mapping) else None
 
-    def dirs(self) -> list:
-        """Return paths to dirs."""
-        return [p for p in self if p[0] != ':' and not 'size' in self[p]]
+    def __setitem__(self, key, value):
+        """Store non-metadata dict values compactly as :class:`Entry`."""
+        if key[:1] != ':':
+            if isinstance(value, dict): value = Entry.pack(value)
+            if self._index is not None:
+                size = self._size(value)
+                if key in self and (self._size(self[key]) is None) != (size is None):
+                    self._index.remove(key, size is None) # file <-> dir
+                self._index.add(key, size)
+        super().__setitem__(key, value)
 
-    def files(self) -> list:
-        """Return paths to files."""
-        return [p for p in self if p[0] != ':' and 'size' in self[p]]
+    def __delitem__(self, key):
+        if self._index is not None and key[:1] != ':' and key in self:
+            self._index.remove(key, self._size(self[key]) is not None)
+        super().__delitem__(key)
+
+    @property
+    def index(self) -> PathIndex:
+        """Path index of contents, kept up to date once built."""
+        if self._index is None:
+            index = PathIndex()
+            for p,o in self.items():
+                if p[0] != ':': index.add(p, self._size(o))
+            self._index = index
+        return self._index
+
+    def dirs(self, prefix: str='.') -> list:
+        """Return paths to dirs (under prefix)."""
+        return list(self.index.dirs(prefix))
+
+    def files(self, prefix: str='.') -> list:
+        """Return paths to files (under prefix)."""
+        return list(self.index.files(prefix))
 
     def set(self, key: Any, val: Any) -> bool:
         """Set key to val if there's a change, in which case return True."""
@@ -85,7 +389,110 @@ class Fileson(LogDict):
         self[key] = val # change will be recorded by LogDict
         return True
 
-    def scan(self, directory: str, **kwargs) -> None:
+    def changes(self, first: int=None, last: int=None) -> Generator[Tuple[str, Any, Any], None, None]:
+        """Yield (key, old, new) for entries changed by scans first..last.
+
+        Old is the value before scan `first` and new the one after scan
+        `last` (both default to latest scan), None meaning nonexistent.
+        Keys are yielded in the order they were first changed, and only
+        if the net result differs. Metadata keys are skipped.
+
+        This is a single forward pass over the log, keeping values only
+        for keys the scans touched, so it is much lighter than comparing
+        two :meth:`slice` copies of the whole database.
+        """
+        last = last or self.get(':scan:', 0)
+        first = first or last
+        if first > last: return
+        start = self.log.index((':scan:', first))
+        try: end = self.log.index((':scan:', last+1), start)
+        except ValueError: end = len(self.log)
+
+        touched = {t[0]: None for t in self.log[start:end] if t[0][:1] != ':'}
+        old = {}
+        for t in self.log[:start]: # values before the first scan
+            if t[0] in touched:
+                if len(t) == 2: old[t[0]] = t[1]
+                else: old.pop(t[0], None)
+        new = dict(old)
+        for t in self.log[start:end]:
+            if t[0] not in touched: continue
+            if len(t) == 2: new[t[0]] = t[1]
+            else: new.pop(t[0], None)
+        for k in touched:
+            o, n = old.get(k, None), new.get(k, None)
+            if o != n: yield (k, o, n)
+
+    @staticmethod
+    def count_change(changes: dict, key: str, old: Any, new: Any) -> None:
+        """Count an added, modified (old and new) or deleted (new None) entry.
+
+        Changes are counted per top level directory as
+        {topdir: {kind: [count, bytes]}}, bytes of deleted entries
+        from the old value and from the new one otherwise.
+        """
+        kind = 'deleted' if new is None else 'modified' if old is not None else 'added'
+        c = changes.setdefault(key.split(os.sep)[0], {}).setdefault(kind, [0, 0])
+        c[0] += 1
+        c[1] += Fileson._size(old if new is None else new) or 0
+
+    def scan_stats(self, changes: dict, ops: int, diffs: list=None) -> dict:
+        """Return aggregate statistics of current state for :stats: record.
+
+        Statistics of the previous scan are updated with diffs if they are
+        recorded (and the largest file or deepest dir was not removed),
+        otherwise all files are walked.
+
+        Args:
+            changes (dict): Changes of the scan, see :meth:`count_change`
+            ops (int): Log entries of the scan, including :stats: itself
+            diffs (list): (path, old, new) values changed in the scan
+        """
+        files, dirs, total = self.index.stats()
+        prev = self.get(':stats:', None) if diffs is not None else None
+        if prev and prev.get('scan', None) == self.get(':scan:', 0) - 1:
+            stats = self._update_stats(prev, diffs)
+            if stats:
+                stats.update({'scan': self.get(':scan:', 0), 'files': files,
+                    'dirs': dirs, 'bytes': total, 'ops': ops, 'changes': changes})
+                return stats
+        histogram, maxsize = [], 0 # count of sizes in [2^(i-1), 2^i) at i
+        for p in self.index.files():
+            size = self[p]['size']
+            maxsize = max(maxsize, size)
+            i = size.bit_length()
+            if i >= len(histogram): histogram += [0] * (i+1-len(histogram))
+            histogram[i] += 1
+        return {'scan': self.get(':scan:', 0), 'files': files, 'dirs': dirs,
+                'bytes': total, 'max_size': maxsize, 'depth': self.index.depth(),
+                'ops': ops, 'changes': changes, 'histogram': histogram}
+
+    def _update_stats(self, prev: dict, diffs: list) -> dict:
+        """Return histogram, max_size and depth of prev updated with diffs,
+        or None if they need to be computed from scratch."""
+        histogram = list(prev['histogram'])
+        lostsize = lostdepth = False # largest file or deepest dir removed
+        maxsize, depth = 0, 0 # of added ones
+        for p,old,new in diffs:
+            for v,sign in ((old, -1), (new, 1)):
+                if v is None: continue
+                size = self._size(v)
+                if size is None: # dir or link
+                    if sign > 0: depth = max(depth, p.count(os.sep))
+                    else: lostdepth = lostdepth or p.count(os.sep) >= prev['depth']
+                    continue
+                if sign > 0: maxsize = max(maxsize, size)
+                else: lostsize = lostsize or size >= prev['max_size']
+                i = size.bit_length()
+                if i >= len(histogram): histogram += [0] * (i+1-len(histogram))
+                histogram[i] += sign
+        if lostsize and maxsize < prev['max_size']: return None
+        if lostdepth and depth < prev['depth']: return None
+        while histogram and not histogram[-1]: histogram.pop()
+        return {'max_size': max(maxsize, prev['max_size']),
+                'depth': max(depth, prev['depth']), 'histogram': histogram}
+
+    def scan(self, directory: str, **kwargs) -> bool:
         """Scan a directory for objects or changes.
 
         Every invocation creates a new 'run', a version to Fileson
@@ -95,12 +502,31 @@ class Fileson(LogDict):
 
         Args:
             directory (str): Directory to scan
-            **kwargs: Booleans 'verbose' and 'strict' control behaviour
+            **kwargs: Booleans 'verbose' and 'strict' control behaviour,
+                'checksum' and 'skip' list of patterns (see :mod:`skip`)
+                what is stored.
+                Set 'scanner' to 'async' to use :mod:`ascan` with
+                'workers' concurrent calls (default 16) for network drives.
+                Checksums are also looked up from and stored to 'cache', a
+                :class:`csumcache.ChecksumCache` or its filename.
+                For a partial scan, give relative 'paths' to rescan (just
+                the entries) and 'subtrees' (entries and everything under).
+                Files with several hard links get the same 'hardlink' id,
+                the first path of them seen in the scan (a partial scan
+                rescans all links of groups it touches), and are checksummed
+                only once per scan (the async scanner may still hash links
+                concurrently).
+
+        Returns:
+            bool: True if a scan was written, False for a partial scan that
+            found no changes (nothing is written then).
         """
         checksum = kwargs.get('checksum', None)
         verbose = kwargs.get('verbose', 0)
         skiplist = kwargs.get('skip', [])
         strict = kwargs.get('strict', False)
+        scanner = kwargs.get('scanner', None) or 'sync'
+        if not scanner in ('sync', 'async'): raise ValueError(f'Unknown scanner {scanner}')
         
         # On strict mode, use full path as key, otherwise just the filename.
         # Additionally, store the modified time and size to detect changes.
@@ -108,55 +534,104 @@ class Fileson(LogDict):
         make_key = lambda p,f: (p if strict else p.split(os.sep)[-1],
                 f['modified_gmt'], f['size'])
         
-        # Set metadata for run
-        self[':scan:'] = self.get(':scan:', 0) + 1 # first in a scan!
-        self[':directory:'] = directory
-        self[':checksum:'] = checksum
-        self[':date_gmt:'] = gmt_str()
+        # Entries to be seen again, or removed
+        paths, subtrees = kwargs.get('paths', None), kwargs.get('subtrees', None)
+        partial = paths is not None or subtrees is not None
+        if partial: # keep only top-most subtrees and paths outside them
+            paths, subtrees = set(paths or ()), set(subtrees or ())
+            def inside(p): # strictly under one of the subtrees
+                while p not in ('', '.'):
+                    p = os.path.dirname(p)
+                    if (p or '.') in subtrees: return True
+                return False
+            paths = {p for p in paths if p not in subtrees and not inside(p)}
+            subtrees = {s for s in subtrees if not inside(s)}
+            missing = {p for p in paths if p in self}
+            for s in subtrees:
+                missing |= set(self.index.files(s)) | set(self.index.dirs(s))
+            missing.discard('.')
+
+            # Other links of groups seen again are rescanned too, so every
+            # group gets a new id and no stale one is left behind
+            ids = {self[p].get('hardlink', None) for p in missing
+                    if isinstance(self[p], Mapping)} - {None}
+            if ids:
+                more = {p for p in self.files() if self[p].get('hardlink', None) in ids}
+                paths |= more - missing
+                missing |= more
+        else: missing = set(self.files()) | set(self.dirs())
 
         # Create checksum cache, make_key is used to store and retrieve
         ccache = {}
         if checksum:
-            for p in self.files():
+            for p in (missing if partial else self.files()):
                 f = self[p]
-                if isinstance(f, dict) and checksum in f:
+                if isinstance(f, Mapping) and checksum in f:
                     ccache[make_key(p,f)] = f[checksum]
 
-        missing = set(self.files()) | set(self.dirs())
-        skip = lambda p: any(pat in p for pat in skiplist)
+        skip = SkipMatcher(skiplist, directory)
+
+        # Set metadata for run, for a partial scan only once something changes
+        start = None
+        def begin():
+            nonlocal start
+            if start is not None: return
+            start = len(self.log)
+            self[':scan:'] = self.get(':scan:', 0) + 1 # first in a scan!
+            self[':directory:'] = directory
+            self[':checksum:'] = checksum
+            self[':date_gmt:'] = gmt_str()
+        if not partial: begin()
+
+        # Set entry if changed and count the change for :stats:
+        changes, diffs = {}, []
+        def record(p, f):
+            old = self.get(p, None)
+            if old == f: return
+            begin()
+            self[p] = f
+            self.count_change(changes, p, old, f)
+            diffs.append((p, old, f))
 
         startTime, fileCount, byteCount, seenG = time.time(), 0, 0, 0
+        groups = {} # (device, inode): hardlink id of the links
+        inodes = {} # path: (device, inode) of links being scanned
+        linked = {} # (device, inode): checksum, other links are not hashed again
 
-        if verbose: print('Scanning', directory, 'skipping', skiplist)
+        def describe(e): return entry_record(e, directory)
 
-        for e in scantree(directory, skip):
-            p = os.path.relpath(e.path, directory)
-            missing.discard(p)
-            # Store symlink details
-            if e.is_symlink():
-                # Get relative path to target
-                relative = os.path.relpath(os.readlink(e.path), directory)
-                self.set(p, { 'link': relative,
-                              'modified_gmt': gmt_str(e.stat().st_mtime),
-                              'permissions': e.stat().st_mode })
-                if verbose > 1: print('Symlink', p, '->', self[p]['link'])
-            # Process directories
-            elif e.is_dir(follow_symlinks=False):
-                self.set(p, { 'modified_gmt': gmt_str(e.stat().st_mtime),
-                              'permissions': e.stat().st_mode})
-            # Should be a file
-            else:
-                f = { 'size': e.stat().st_size,
-                     'modified_gmt': gmt_str(e.stat().st_mtime),
-                     'permissions': e.stat().st_mode }
+        def prepare(p, f, e):
+            """Set hardlink id and checksum from caches, True if hash needed."""
+            if 'hardlink' in f:
+                inodes[p] = f['hardlink']
+                f['hardlink'] = groups.setdefault(f['hardlink'], p)
+            if not checksum or not 'size' in f: return False
+            f[checksum] = ccache.get(make_key(p,f), None) or \
+                    linked.get(inodes.get(p, None), None)
+            if pcache and f[checksum]: # known from this DB, store or keep fresh
+                pcache.put(e.path, e.stat(), checksum, f[checksum])
+            elif pcache: f[checksum] = pcache.get(e.path, e.stat(), checksum)
+            if verbose > 1 and not f[checksum]: print(checksum, p)
+            return not f[checksum]
 
-                if checksum:
-                    if verbose > 1 and not make_key(p,f) in ccache:
-                        print(checksum, p)
-                    f[checksum] = ccache.get(make_key(p,f), None) or \
-                            Fileson.summer[checksum](e.path, f)
+        def digest(e, f):
+            with metrics.timer('hash_seconds', 'Checksum time per file'):
+                f[checksum] = Fileson.summer[checksum](e.path, f)
+            hash_bytes.inc(f['size'])
+            if pcache: pcache.put(e.path, e.stat(), checksum, f[checksum])
 
-                self.set(p, f)
+        def emit(p, f):
+            nonlocal fileCount, byteCount, seenG
+            missing.discard(p)
+            record(p, f)
+            if 'link' in f:
+                if verbose > 1: print('Symlink', p, '->', f['link'])
+            elif not 'size' in f: scan_dirs.inc()
+            else:
+                scan_files.inc()
+                scan_bytes.inc(f['size'])
+                inode = inodes.pop(p, None)
+                if checksum and inode: linked[inode] = f[checksum]
 
                 if verbose >= 1:
                     fileCount += 1
@@ -166,6 +641,97 @@ class Fileson(LogDict):
                         secs = time.time() - startTime
                         print(f'{fileCount} files, {seenG:.2f} GiB in {secs}s')
 
+        if verbose: print('Scanning', directory, 'skipping', skiplist)
+
+        # Persistent cache shared with other scans, opened here if a filename
+        pcache = kwargs.get('cache', None)
+        if isinstance(pcache, str): pcache = ChecksumCache(pcache)
+        try:
+            if partial: # given entries and subtrees with the sync scanner
+                def entries():
+                    for p in sorted(paths | subtrees):
+                        if p == '.': continue
+                        try: e = PathEntry(os.path.join(directory, p))
+                        except OSError: continue # gone
+                        if skip(e): subtrees.discard(p)
+                        else: yield e
+                    for p in sorted(subtrees):
+                        fp = os.path.join(directory, p) if p != '.' else directory
+                        if os.path.isdir(fp) and not os.path.islink(fp):
+                            yield from scantree(fp, skip)
+                for e in entries():
+                    p = os.path.relpath(e.path, directory)
+                    f = describe(e)
+                    if prepare(p, f, e): digest(e, f)
+                    emit(p, f)
+            elif scanner == 'async':
+                import ascan
+                ascan.walk(directory, skip, describe, prepare, digest, emit,
+                        kwargs.get('workers', None) or 16)
+            else:
+                for e in scantree(directory, skip):
+                    p = os.path.relpath(e.path, directory)
+                    f = describe(e)
+                    if prepare(p, f, e): digest(e, f)
+                    emit(p, f)
+        finally:
+            if pcache and pcache is not kwargs['cache']: pcache.close()
+
         for p in missing:
             if verbose > 1: print('Removed missing entry', p)
-            del self[p] # remove elements not seen this time
\ No newline at end of file
+            begin()
+            self.count_change(changes, p, self[p], None)
+            diffs.append((p, self[p], None))
+            del self[p] # remove elements not seen this time
+
+        if verbose and skip:
+            for pat,(n,size) in skip.skipped.items():
+                print(f'Skipped {n} entries, {size} bytes in files with {pat}')
+        if start is None: return False # partial scan without changes
+
+        # Aggregates of a completed scan, last in a scan
+        stats = self.scan_stats(changes, len(self.log) - start + 1, diffs)
+        if skip: stats['skipped'] = skip.skipped
+        self[':stats:'] = stats
+        return True
+
+    def stats(self) -> dict:
+        """Return :stats: of latest scan if present and complete, or None."""
+        stats = self.get(':stats:', None)
+        if stats and stats.get('scan', None) == self.get(':scan:', 0):
+            return stats
+        return None
+
+    def restat(self) -> 'Fileson':
+        """Return a copy with :stats: records rebuilt for all scans.
+
+        The log is replayed and a :stats: entry inserted at the end of each
+        scan (old ones are recomputed), so databases created before stats
+        were recorded get them as well. Contents are not changed.
+
+        Returns:
+            Fileson: A copy with new log
+        """
+        fs = self.__class__()
+        changes, diffs, start = {}, [], 0
+
+        def finish():
+            if fs.get(':scan:', 0):
+                fs[':stats:'] = fs.scan_stats(changes, len(fs.log) - start + 1, diffs)
+
+        for t in self.log:
+            if t[0] == ':stats:': continue
+            if t[0] == ':scan:':
+                finish()
+                changes, diffs, start = {}, [], len(fs.log)
+            if t[0][0] != ':':
+                old = fs.get(t[0], None)
+                if len(t) == 1 and old is None: # keep deletes of non-existing
+                    fs.log.append(t)
+                    continue
+                self.count_change(changes, t[0], old, t[1] if len(t)==2 else None)
+                diffs.append((t[0], old, t[1] if len(t)==2 else None))
+            if len(t) == 2: fs[t[0]] = t[1]
+            else: del fs[t[0]]
+        finish()
+        return fs
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from fileson import Fileson, gmt_str, gmt_epoch
 from logdict import LogDict
-from mycrypt import AESFile, sha1, calc_etag
+from mycrypt import AESFile, sha1, calc_etag, ctr_decrypt
 from hash import sha_file
-import argparse, os, sys, binascii, time, hashlib, inspect, shutil, re
-import boto3, threading
+from throttle import ThrottledFile, Tuner, limiter
+from skip import glob_regex
+import metrics, sparse
+import argparse, os, sys, binascii, time, hashlib, inspect, shutil, re, json, random, functools
+import threading
 
 class BotoProgress(object):
     def __init__(self, ptype):
@@ -16,6 +21,7 @@ class BotoProgress(object):
         self._lock = threading.Lock()
 
     def __call__(self, bytes_amount):
+        metrics.counter(self._type+'_bytes', f'Bytes {self._type}ed').inc(bytes_amount)
         with self._lock:
             self._seen += bytes_amount
             if self._last + 2**20 > self._seen: return # every 1 MB
@@ -31,16 +37,89 @@ class S3Action(argparse.Action):
         if not m: raise ValueError('S3 address in format s3://bucket/objpath')
         setattr(namespace, self.dest, (m.group(1), m.group(2)))
 
-# Return key or if a filename, its contents
-def key_or_file(key):
-    if isinstance(key, bytes): return key # passthrough
+def count_retries(request, **kwargs):
+    """Botocore request-created hook to count retried requests."""
+    if request.context.get('retries', {}).get('attempt', 1) > 1:
+        metrics.counter('s3_retries', 'Retried S3 requests').inc()
+
+_s3 = None
+def s3_client():
+    """Return shared boto3 S3 client with retry counting."""
+    global _s3
+    if not _s3:
+        import boto3 # slow to import, only when needed
+        _s3 = boto3.client('s3')
+        _s3.meta.events.register('request-created.s3', count_retries)
+    return _s3
+
+# Shared by all transfers, so concurrency adapts over a backup run
+tuner = Tuner()
+
+def fixed_concurrency(concurrency=None):
+    """Return concurrency as int, or None for 'auto' (None)."""
+    return int(concurrency) if concurrency and concurrency != 'auto' else None
+
+def transfer_config(concurrency=None):
+    """Return boto3 TransferConfig, concurrency 'auto' (None) or fixed.
+
+    A fixed concurrency applies to this transfer only, the shared tuner
+    keeps adapting for others.
+    Part size is kept at 8 MiB so calc_etag() defaults stay valid.
+    """
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=8*2**20, multipart_chunksize=8*2**20,
+            max_concurrency=fixed_concurrency(concurrency) or tuner.concurrency)
+
+@functools.lru_cache(maxsize=None)
+def _load_key(key: str) -> bytes:
     if os.path.exists(key):
         with open(key, 'r') as f: key = ''.join(f.read().split())
-    return bytes.fromhex(key)
+    return check_key(bytes.fromhex(key))
+
+def check_key(key: bytes) -> bytes:
+    """Return key if valid for AES256, raise ValueError otherwise."""
+    if len(key) != 32: raise ValueError(f'Key must be 32 bytes (64 hexes), not {len(key)}')
+    return key
+
+# Return key or if a filename, its contents (read once per process)
+def key_or_file(key):
+    if isinstance(key, bytes): return check_key(key) # passthrough
+    return _load_key(key)
+
+KDF = {
+    'pbkdf2': lambda pw, salt, cost: hashlib.pbkdf2_hmac('sha256', pw, salt, cost),
+    'scrypt': lambda pw, salt, cost: hashlib.scrypt(pw, salt=salt, n=2**cost,
+        r=8, p=1, maxmem=2**(cost+11), dklen=32), # 128*r*n bytes plus room
+}
+DEFAULT_COST = {'pbkdf2': '1M', 'scrypt': '17'}
+
+def derive_key(password: str, salt: str, kdf: str='pbkdf2', cost: int=10**6) -> bytes:
+    """Derive a 32 byte key from password and salt.
+
+    Cost is iterations for PBKDF2-SHA256, and log2 of N for scrypt (with
+    r=8, p=1, so it uses 2**cost KiB of memory).
+    """
+    return KDF[kdf](password.encode('utf8'), salt.encode('utf8'), cost)
+
+def calibrate(kdf: str, seconds: float) -> int:
+    """Return cost for kdf taking about given seconds on this machine."""
+    if kdf == 'scrypt': # each step doubles time and memory, up to 1 GiB
+        for cost in range(10, 21):
+            start = time.time()
+            derive_key('calibrate', 'salt', kdf, cost)
+            if time.time() - start >= seconds: break
+        return cost
+    start, n = time.time(), 10**5
+    derive_key('calibrate', 'salt', kdf, n)
+    return max(1, int(n * seconds / (time.time() - start)))
 
 # Function per command
 def keygen(args):
     """Create a 32 byte key for AES256 encryption with a password and salt."""
+    if args.calibrate:
+        cost = calibrate(args.kdf, args.calibrate)
+        print(f'Use --kdf {args.kdf} -i {cost} for about {args.calibrate} s per key')
+        return
     if not args.password:
         if args.verbose: print('No password specified, generating random key')
         print(os.urandom(32).hex())
@@ -48,13 +127,12 @@ def keygen(args):
     if not args.salt:
         print('Specify password AND salt or neither!')
         return
-    iterations = int(args.iterations.replace('M', '000k').replace('k', '000'))
+    cost = int((args.iterations or DEFAULT_COST[args.kdf]).replace('M',
+        '000k').replace('k', '000'))
     start = time.time()
-    keyhex = hashlib.pbkdf2_hmac('sha256', args.password.encode('utf8'),
-        args.salt.encode('utf8'), iterations).hex()
-    print(keyhex)
+    print(derive_key(args.password, args.salt, args.kdf, cost).hex())
     if args.verbose: print('Generating that took %.3f seconds' % (time.time()-start))
-keygen.args = 'password salt iterations verbose'.split()
+keygen.args = 'password salt kdf iterations calibrate verbose'.split()
 
 def cryptfile(infile, outfile, verbose=False):
     startTime, bs = time.time(), 0
@@ -87,7 +165,8 @@ def etag(args):
     if args.keyfile:
         fp = AESFile(args.input, 'rb', key_or_file(args.keyfile),
                 iv=bytes.fromhex(args.iv))
-    else: fp = open(args.input, 'rb')
+    elif isinstance(args.input, str): fp = open(args.input, 'rb')
+    else: fp = args.input # e.g. sparse.ExtentReader
     et = calc_etag(fp, args.partsize or 8)
     if not args.quiet: print(et)
     fp.close()
@@ -96,27 +175,77 @@ etag.args = 'input quiet partsize keyfile iv'.split()
 
 def upload(args):
     bucket, objpath = args.s3path
-    s3 = boto3.client('s3')
+    s3 = s3_client()
+    if isinstance(args.input, str): size = os.path.getsize(args.input)
+    else: size = args.input.size # sparse.ExtentReader
     if args.keyfile:
         fp = AESFile(args.input, 'rb', key_or_file(args.keyfile),
                 iv=bytes.fromhex(args.iv))
-    else: fp = open(args.input, 'rb')
+    elif isinstance(args.input, str): fp = open(args.input, 'rb')
+    else: fp = args.input
     if args.verbose: print('Upload', args.input, 'to', bucket, objpath)
-    extra = {'Callback': BotoProgress('upload')}
+    extra = {'Callback': BotoProgress('upload'),
+            'Config': transfer_config(args.concurrency)}
     if args.deep_archive: extra['ExtraArgs'] = {'StorageClass': 'DEEP_ARCHIVE'}
-    s3.upload_fileobj(fp, bucket, objpath, **extra)
+    start = time.time()
+    s3.upload_fileobj(ThrottledFile(fp, limiter(args.bwlimit)), bucket, objpath, **extra)
+    tuner.record(size, time.time()-start, not fixed_concurrency(args.concurrency))
     fp.close()
-upload.args = 'input s3path keyfile iv deep_archive verbose'.split()
+upload.args = 'input s3path keyfile iv deep_archive bwlimit concurrency verbose'.split()
 
 def download(args):
     bucket, objpath = args.s3path
-    s3 = boto3.client('s3')
+    s3 = s3_client()
     if args.keyfile: fp = AESFile(args.output, 'wb', key_or_file(args.keyfile))
     else: fp = open(args.output, 'wb')
     if args.verbose: print('Download', bucket, objpath, 'to', args.output)
-    s3.download_fileobj(bucket, objpath, fp, Callback=BotoProgress('download'))
+    start = time.time()
+    s3.download_fileobj(bucket, objpath, ThrottledFile(fp, limiter(args.bwlimit)),
+            Callback=BotoProgress('download'), Config=transfer_config(args.concurrency))
+    tuner.record(os.path.getsize(args.output), time.time()-start,
+            not fixed_concurrency(args.concurrency))
     fp.close()
-download.args = 's3path output keyfile verbose'.split()
+download.args = 's3path output keyfile bwlimit concurrency verbose'.split()
+
+def s3_location(destination):
+    """Return (bucket, folder) for s3://bucket/folder, None if not S3."""
+    m = re.match('s3://(\w+)/(.+)', destination)
+    return (m.group(1), m.group(2)) if m else None
+
+def blob_source(fpath, extents=None):
+    """Return fpath, or a reader of just the data extents of a sparse file."""
+    return fpath if extents is None else sparse.ExtentReader(fpath, extents)
+
+def stored_size(o):
+    """Return bytes stored for a backup log entry (without the iv)."""
+    if 'extents' in o: return sum(n for _,n in o['extents'])
+    return o['size']
+
+def blob_writer(destination, key=None, deep_archive=False, bwlimit=None,
+        concurrency=None):
+    """Return function(input, name, iv, extents=None) storing a file to
+    backup destination.
+
+    Files are encrypted with iv if key is given, and only the given data
+    extents of sparse files are stored. For S3, bwlimit is shared by all
+    transfers made with the returned function.
+    """
+    loc = s3_location(destination)
+    if loc:
+        bucket, folder = loc
+        bwlimit = limiter(bwlimit) # one bucket for the whole run
+        myargs = namedtuple('myargs', 'input s3path keyfile iv deep_archive bwlimit concurrency verbose')
+        return lambda a,b,i,x=None: upload(myargs(blob_source(a, x),
+            (bucket, folder+'/'+b), key, i, deep_archive, bwlimit, concurrency, False))
+    elif key:
+        myargs = namedtuple('myargs', 'input output key iv verbose force')
+        return lambda a,b,i,x=None: encrypt(myargs(blob_source(a, x),
+            os.path.join(destination, b), key, i, False, True))
+    def copy(a, b, i, x=None):
+        if x is None: return shutil.copyfile(a, os.path.join(destination, b))
+        with blob_source(a, x) as fin, open(os.path.join(destination, b), 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+    return copy
 
 def backup(args):
     """Perform backup based on latest Fileson DB state."""
@@ -128,16 +257,29 @@ def backup(args):
     log = Fileson.load(args.logfile)
     uploaded = { log[p]['sha1']: p for p in log.files() }
 
-    files, total = 0, 0
+    # With a shared blob store, blobs uploaded by other DBs are just linked
+    index = Fileson.load(args.index) if args.index else LogDict()
+    shared = { index[p]['sha1']: p for p in index if p[0] != ':' }
+    for k,v in ((':destination:', args.destination), (':keyhash:',
+            sha1(key_or_file(args.keyfile)).hex() if args.keyfile else None)):
+        if index.get(k, v) != v:
+            print(f'Shared index {args.index} has {k} {index[k]}, not {v}!')
+            return
+
+    files, total, links, seen = 0, 0, 0, set()
     for p in fs.files():
         o = fs[p]
-        if not o['sha1'] in uploaded:
+        if o['sha1'] in uploaded or o['sha1'] in seen: continue
+        seen.add(o['sha1']) # hard links and other copies stored once
+        if o['sha1'] in shared: links += 1
+        else:
             files += 1
             total += o['size']
     print(f'{files} files to back up, total {total/1024**2:.1f} MiB')
+    if links: print(f'{links} files already in shared blob store')
     if args.simulate and not args.verbose: return
     
-    if files == 0:
+    if files == 0 and links == 0:
         print('No new files to back up.')
         return
 
@@ -147,23 +289,21 @@ def backup(args):
     seed = log[':date_gmt:'] = gmt_str()
     log[':destination:'] = args.destination
 
-    if args.keyfile:
-        key = key_or_file(args.keyfile)
-        log[':keyhash:'] = sha1(key).hex()
-
-    m = re.match('s3://(\w+)/(.+)', args.destination)
-    if m:
-        bucket, folder = m.group(1), m.group(2)
-        myargs = namedtuple('myargs', 'input s3path keyfile iv deep_archive verbose')
-        make_backup = lambda a,b,i: upload(myargs(a, (bucket, folder+'/'+b),
-            key if args.keyfile else None, i, args.deep_archive, False))
-    else:
-        if args.keyfile:
-            myargs = namedtuple('myargs', 'input output key iv verbose force')
-            make_backup = lambda a,b,i: encrypt(myargs(a,
-                os.path.join(args.destination, b), key, i, False, True))
-        else: make_backup = lambda a,b,i: shutil.copyfile(a,
-                os.path.join(args.destination, b))
+    key = key_or_file(args.keyfile) if args.keyfile else None
+    if key: log[':keyhash:'] = sha1(key).hex()
+
+    if args.index:
+        log[':index:'] = os.path.abspath(args.index) # for gc to find the others
+        if not args.simulate: index.startLogging(args.index)
+        for k in (':destination:', ':keyhash:'):
+            if not k in index and k in log: index[k] = log[k]
+        logs = dict(index.get(':logs:', {})) # every log sharing the index
+        logs[os.path.abspath(args.logfile)] = os.path.abspath(args.dbfile)
+        if logs != index.get(':logs:', None): index[':logs:'] = logs
+
+    m = s3_location(args.destination)
+    make_backup = blob_writer(args.destination, key,
+            args.deep_archive, args.bwlimit, args.concurrency)
     
     try:
         if not args.simulate:
@@ -177,7 +317,7 @@ def backup(args):
                 iv = binascii.hexlify(os.urandom(16)).decode()
                 fpath = args.dbfile
                 etargs = namedtuple('myargs', 'input quiet partsize keyfile iv')
-                et = etag(etargs(fpath, True, None, args.keyfile, iv)) # etag to log
+                et = etag(etargs(fpath, True, None, key, iv)) # etag to log
                 make_backup(fpath, name, iv)
                 
                 log[name] = { 'sha1': dbsha, 'size': os.path.getsize(args.dbfile),
@@ -189,16 +329,30 @@ def backup(args):
             if o['sha1'] in uploaded:
                 if args.verbose > 1: print('Already uploaded', p)
                 continue
+            if o['sha1'] in shared:
+                name = shared[o['sha1']]
+                log[name] = index[name] # reference to blob in shared store
+                uploaded[o['sha1']] = p
+                if args.verbose > 1: print('Linked', p, 'to shared', name)
+                continue
             name = sha1(seed+o['sha1']).hex() # deterministic random name
             iv = name[:32] # use part of name as IV, quite hard to exploit
             fpath = os.path.join(fs[':directory:'], p)
+            ext = sparse.extents(fpath) # only data of sparse files is stored
             etargs = namedtuple('myargs', 'input quiet partsize keyfile iv')
-            et = etag(etargs(fpath, True, None, args.keyfile, iv)) # etag to log
+            et = etag(etargs(blob_source(fpath, ext), True, None, key, iv)) # etag to log
 
-            if not args.simulate: make_backup(fpath, name, iv)
+            log_entry = { 'sha1': o['sha1'], 'size': o['size'], 'iv': iv, 'etag': et }
+            if ext is not None: log_entry['extents'] = ext
+            if not args.simulate:
+                with metrics.timer('backup_seconds', 'Backup time per object'):
+                    make_backup(fpath, name, iv, ext)
+                metrics.counter('backup_files', 'Files backed up').inc()
+                metrics.counter('backup_bytes', 'Bytes backed up').inc(stored_size(log_entry))
 
-            log[name] = { 'sha1': o['sha1'], 'size': o['size'], 'iv': iv, 'etag': et }
+            log[name] = log_entry
             uploaded[o['sha1']] = p # mark as uploaded to avoid duplicates
+            if args.index: index[name] = log[name]
             if args.verbose: print(f'Backup {fpath} to {name}')
             if args.verbose > 1: print(log[name])
             backedFiles += 1
@@ -212,13 +366,287 @@ def backup(args):
 
     if not args.simulate:
         log.endLogging()
+        if args.index: index.endLogging()
         print('Closed log file. Uploading it to the backup...')
         
         # Save the log file to the backup
         random_iv = binascii.hexlify(os.urandom(16)).decode()
         make_backup(args.logfile, os.path.basename(args.logfile), random_iv)
         print('Backup complete.')
-backup.args = 'dbfile logfile destination keyfile deep_archive simulate verbose'.split() # args to add
+        if m: print('Transferred', tuner.summary())
+backup.args = 'dbfile logfile destination keyfile deep_archive index bwlimit concurrency simulate verbose'.split() # args to add
+
+def retained_sha1s(fs, keep=1, since=None):
+    """Return SHA1s referenced by retained versions of a Fileson DB.
+
+    The latest `keep` scans are retained, as well as every version that
+    was current at or after `since` (YYYY-MM-DD). Union of those states
+    is the state at the end of the oldest retained version plus all
+    values set after it, so a single pass over the log suffices.
+    """
+    last = fs.get(':scan:', 0)
+    first = last - max(keep, 1) + 1
+    if since: # versions current at or after since, incl. one before it
+        dates, version = {}, 0
+        for t in fs.log:
+            if len(t)<2: continue
+            if t[0] == ':scan:': version = t[1]
+            elif t[0] == ':date_gmt:': dates[version] = t[1]
+        before = [v for v,d in dates.items() if d < since]
+        first = min(first, max(before) if before else 0)
+    first = max(first, 0)
+    cut = fs.log.index((':scan:', first+1)) if first < last else len(fs.log)
+
+    state = {}
+    for t in fs.log[:cut]:
+        if t[0][0] == ':': continue
+        if len(t)==2: state[t[0]] = t[1].get('sha1', None)
+        else: state.pop(t[0], None)
+    live = set(state.values())
+    for t in fs.log[cut:]:
+        if len(t)==2 and t[0][0] != ':': live.add(t[1].get('sha1', None))
+    live.discard(None)
+    return live
+
+def blob_destinations(log):
+    """Return {name: destination} of blobs (last write) in a backup log."""
+    dests, dest = {}, ''
+    for t in log.log:
+        if len(t)<2: continue
+        if t[0] == ':destination:': dest = t[1]
+        elif t[0][0] != ':': dests[t[0]] = dest
+    return dests
+
+def drop_blobs(logfile, log, deleted):
+    """Rewrite backup log atomically without the deleted blobs."""
+    tmpfile = logfile + '.tmp'
+    with open(tmpfile, 'w', encoding='utf8') as fout:
+        for t in log.log:
+            if t[0] in deleted: continue
+            json.dump(t, fout, default=dict)
+            fout.write('\n')
+    os.replace(tmpfile, logfile)
+
+def gc(args):
+    """Delete backed up blobs not referenced by given Fileson DBs.
+
+    If blobs are shared through an index (backup -x), every database
+    backed up with the index must be given, and deleted blobs are dropped
+    from the index and all backup logs using it.
+    """
+    live = set()
+    for dbfile in args.dbfiles:
+        fs = Fileson.load(dbfile)
+        if fs.get(':checksum:', None) != 'sha1':
+            print(dbfile, 'does not have SHA1 checksums, refusing to gc.')
+            return
+        live |= retained_sha1s(fs, args.keep, args.since)
+    if args.verbose: print(len(live), 'SHA1s referenced by', *args.dbfiles)
+
+    log = Fileson.load(args.logfile)
+    logs = {os.path.abspath(args.logfile): log}
+    indexfile = log.get(':index:', None) or (args.logfile if ':logs:' in log else None)
+    if indexfile: # a blob may be referenced by any log sharing the index
+        index = log if ':logs:' in log else Fileson.load(indexfile)
+        shared = index.get(':logs:', {})
+        given = {os.path.abspath(d) for d in args.dbfiles}
+        missing = [d for d in shared.values() if not d in given]
+        if missing or not shared:
+            print(f'Blobs are shared through {indexfile}, refusing to gc without',
+                    'all its databases:', *missing or ['(none recorded)'])
+            return
+        logs = {os.path.abspath(indexfile): index}
+        for l in shared:
+            logs[l] = log if l == os.path.abspath(args.logfile) else Fileson.load(l)
+
+    # Find out where each blob went, and which ones are no longer needed.
+    # Only deterministically named blobs are eligible, the DB and log
+    # copies under their own names are always kept.
+    dead, blobs = defaultdict(set), {}
+    for l in logs.values():
+        dests = blob_destinations(l)
+        for name in l.files():
+            if re.fullmatch('[0-9a-f]{40}', name) and \
+                    not l[name]['sha1'] in live:
+                dead[dests[name]].add(name)
+                blobs[name] = l[name]
+    dead = {dest: sorted(names) for dest,names in dead.items()}
+
+    total = sum(stored_size(blobs[n]) for names in dead.values() for n in names)
+    count = sum(len(names) for names in dead.values())
+    for dest,names in dead.items():
+        size = sum(stored_size(blobs[n]) for n in names)
+        print(f'{dest}: {len(names)} blobs, {size/1024**2:.1f} MiB')
+    print(f'{count} blobs to delete, total {total/1024**2:.1f} MiB reclaimable')
+    if args.simulate or not count: return
+
+    deleted = set()
+    try:
+        for dest,names in dead.items():
+            loc = s3_location(dest)
+            if loc:
+                bucket, folder = loc
+                s3 = s3_client()
+                for i in range(0, len(names), args.batch):
+                    batch = names[i:i+args.batch]
+                    res = s3.delete_objects(Bucket=bucket, Delete={'Quiet': True,
+                        'Objects': [{'Key': folder+'/'+n} for n in batch]})
+                    failed = {e['Key'].split('/')[-1] for e in res.get('Errors', [])}
+                    for e in res.get('Errors', []):
+                        print('Failed to delete', e['Key'], e.get('Message', ''))
+                    deleted.update(n for n in batch if not n in failed)
+                    if args.verbose: print(f'Deleted {len(deleted)} / {count}')
+            else:
+                for n in names:
+                    try: os.unlink(os.path.join(dest, n))
+                    except FileNotFoundError:
+                        if args.verbose > 1: print('Already gone', n)
+                    deleted.add(n)
+    except KeyboardInterrupt:
+        print('Aborted while deleting. Compacting log for deleted blobs')
+
+    # Write compacted logs without deleted blobs
+    for logfile,l in logs.items():
+        if any(name in l for name in deleted): drop_blobs(logfile, l, deleted)
+    print(f'Deleted {len(deleted)} blobs, compacted', *logs)
+gc.args = 'logfile dbfiles keep since batch simulate verbose'.split() # args to add
+
+ARCHIVED = {'GLACIER', 'DEEP_ARCHIVE'} # storage classes not readable without restore
+
+def verify(args):
+    """Verify backed up blobs against backup log, re-upload bad ones.
+
+    Contents of archived blobs are not sampled, and sampled blobs whose
+    range could not be read are reported as not checkable.
+    """
+    fs = Fileson.load(args.dbfile)
+    log = Fileson.load(args.logfile)
+    key = key_or_file(args.keyfile) if args.keyfile else None
+    if key and sha1(key).hex() != log.get(':keyhash:', None):
+        print('Provided key hash does not match backup log!')
+        return
+    overhead = 16 if ':keyhash:' in log else 0 # iv before encrypted data
+    if overhead and not key and args.sample:
+        print('Need the key to check contents of encrypted blobs.')
+        return
+
+    # Blobs expected per destination, checked ones are removed
+    pending = defaultdict(set)
+    for name,dest in blob_destinations(log).items():
+        if name in log: pending[dest].add(name)
+    sources = {fs[p]['sha1']: p for p in fs.files() if 'sha1' in fs[p]}
+    bad, sampled, unchecked, extra, ok, archived = {}, [], {}, 0, 0, 0
+    lock = threading.Lock()
+    errors = (OSError,) # per sample, not fatal
+    if any(s3_location(dest) for dest in pending):
+        from botocore.exceptions import BotoCoreError, ClientError
+        errors += (BotoCoreError, ClientError)
+
+    def check(dest, name, size, etag, storage=None):
+        """Compare a listed object to the log, called from worker threads."""
+        nonlocal extra, ok, archived
+        with lock:
+            if not name in pending[dest]:
+                extra += 1
+                return
+            pending[dest].discard(name)
+            o = log[name]
+            if size != stored_size(o) + overhead:
+                bad[name] = f'size {size}, expected {stored_size(o) + overhead}'
+            elif etag and o.get('etag', etag) != etag:
+                bad[name] = f'etag {etag}, expected {o["etag"]}'
+            else:
+                ok += 1
+                if random.random() * 100 >= args.sample: return
+                if storage in ARCHIVED: archived += 1
+                else: sampled.append((dest, name))
+
+    def read_range(dest, name, start, length):
+        loc = s3_location(dest)
+        if loc:
+            bucket, folder = loc
+            return s3_client().get_object(Bucket=bucket, Key=folder+'/'+name,
+                    Range=f'bytes={start}-{start+length-1}')['Body'].read()
+        with open(os.path.join(dest, name), 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    def check_range(item):
+        """Compare a random range of blob to the source file, return
+        None if there is no source and the exception if reading failed."""
+        try: return compare_range(*item)
+        except errors as e: return e
+
+    def compare_range(dest, name):
+        o = log[name]
+        p = sources.get(o['sha1'], None)
+        fpath = p and os.path.join(fs[':directory:'], p)
+        if not fpath or os.path.getsize(fpath) != o['size']: return None # unknown
+        stored = stored_size(o) # offsets within data extents of sparse files
+        length = min(args.rangesize * 2**10, stored)
+        if not length: return True
+        start = random.randrange(stored - length + 1)
+        data = read_range(dest, name, start + overhead, length)
+        if key: data = ctr_decrypt(data, key, bytes.fromhex(o['iv']), start)
+        with sparse.ExtentReader(fpath, o['extents']) if 'extents' in o \
+                else open(fpath, 'rb') as f:
+            f.seek(start)
+            return f.read(length) == data
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        # Objects are listed concurrently, per first letter of names
+        jobs = []
+        for dest,names in pending.items():
+            loc = s3_location(dest)
+            if loc:
+                def listing(dest, bucket, prefix):
+                    pages = s3_client().get_paginator('list_objects_v2')
+                    for page in pages.paginate(Bucket=bucket, Prefix=prefix):
+                        for o in page.get('Contents', []):
+                            check(dest, o['Key'].split('/')[-1], o['Size'],
+                                    o['ETag'].strip('"'), o.get('StorageClass', None))
+                bucket, folder = loc
+                for c in sorted({n[0] for n in names}):
+                    jobs.append(pool.submit(listing, dest, bucket, f'{folder}/{c}'))
+            else:
+                def local(dest, e):
+                    with open(e.path, 'rb') as f: etag = calc_etag(f)
+                    check(dest, e.name, e.stat().st_size, etag)
+                for e in os.scandir(dest) if os.path.isdir(dest) else []:
+                    if e.name in names: jobs.append(pool.submit(local, dest, e))
+                    else: extra += 1
+        for j in jobs: j.result()
+        if args.verbose: print('Listed', ok + len(bad), 'blobs,', extra, 'not in log')
+
+        for item,res in zip(sampled, pool.map(check_range, sampled)):
+            if res is False: bad[item[1]] = 'content differs from source'
+            elif res is None and args.verbose: print('No source to check', item[1])
+            elif isinstance(res, Exception): unchecked[item[1]] = repr(res)
+        if archived and args.verbose: print(archived, 'archived blobs not sampled')
+
+    for dest,names in pending.items():
+        for name in names: bad[name] = 'missing'
+    for name,reason in sorted(bad.items()): print('BAD', name, reason)
+    for name,reason in sorted(unchecked.items()): print('NOT CHECKABLE', name, reason)
+    print(f'{ok} blobs ok, {len(bad)} bad, {len(sampled)} sampled for content' +
+            (f', {len(unchecked)} not checkable' if unchecked else ''))
+    if not bad or not args.reupload: return
+
+    # Re-upload from sources that still have the same content
+    dests = blob_destinations(log)
+    writers = {}
+    for name in sorted(bad):
+        o = log[name]
+        p = sources.get(o['sha1'], None)
+        fpath = p and os.path.join(fs[':directory:'], p)
+        if not fpath or not os.path.exists(fpath) or sha_file(fpath) != o['sha1']:
+            print('No source for', name)
+            continue
+        if not dests[name] in writers: writers[dests[name]] = blob_writer(
+                dests[name], key, args.deep_archive, args.bwlimit, args.concurrency)
+        print('Re-upload', fpath, 'to', name)
+        writers[dests[name]](fpath, name, o['iv'], o.get('extents', None))
+verify.args = 'dbfile logfile keyfile sample rangesize jobs reupload deep_archive bwlimit concurrency verbose'.split()
 
 def find(args):
     """Locate files in backup based on Fileson DB and backup log."""
@@ -240,7 +668,7 @@ def find(args):
         if k == ':destination:': dest = v
         
         # If value is not a dict, skip
-        if not isinstance(v, dict): continue
+        if not isinstance(v, Mapping): continue
 
         if 'sha1' in v and v['sha1'] in shas:
             files = shas[v['sha1']]
@@ -251,48 +679,167 @@ def find(args):
 
 find.args = 'dbfile logfile search'.split()
 
+WILDCARD = re.compile(r'[*?[]')
+
+def restore_selection(fs, paths):
+    """Return (files, dirs) of Fileson DB selected by path prefixes or globs.
+
+    A directory (given or matching a glob) selects its whole subtree.
+    Prefixes, and globs starting with fixed directories, are looked up
+    from the path index, so only the selected part of the tree is walked.
+    """
+    if not paths: return fs.files(), fs.dirs()
+    prefixes, globs, roots = set(), [], []
+    for p in paths:
+        if not WILDCARD.search(p):
+            p = p.strip('/').strip(os.sep) or '.'
+            prefixes.add(p)
+            roots.append(p)
+            continue
+        globs.append(re.compile(glob_regex(p)).fullmatch)
+        anchored = '/' in p.rstrip('/') or os.sep in p.rstrip(os.sep)
+        fixed = re.split(r'[/\\]', WILDCARD.split(p)[0].lstrip('/'))[:-1]
+        roots.append(os.sep.join(fixed) if anchored and fixed else '.')
+
+    def selected(p):
+        while True:
+            if p in prefixes or any(g(p) for g in globs): return True
+            if p in ('', '.'): return False
+            p = os.path.dirname(p) or '.'
+
+    if '.' in roots: roots = ['.']
+    files, dirs = {}, {}
+    for r in roots:
+        if r in fs and fs._size(fs[r]) is not None: files[r] = True # single file
+        files.update((p, True) for p in fs.files(r) if selected(p))
+        dirs.update((p, True) for p in fs.dirs(r) if selected(p))
+    return list(files), list(dirs)
+
+def blob_names(logfile, sha1s):
+    """Return ({sha1: (blob name, entry)}, metadata) for SHA1s in a backup log.
+
+    The log is streamed and only lines with a wanted SHA1 (or metadata
+    and deletions) are decoded. Supports log.fson~1 history syntax.
+    """
+    logfile, back = Fileson.history(logfile)
+    end = None # :backup: run to stop at
+    if back:
+        with open(logfile, 'r', encoding='utf8') as fin:
+            end = max((json.loads(l)[1] for l in fin if l.startswith('[":backup:",')),
+                    default=0) - back + 1
+    names, owner, meta = {}, {}, {}
+    with open(logfile, 'r', encoding='utf8') as fin:
+        for l in fin:
+            if l.startswith('[":'):
+                t = json.loads(l)
+                if end is not None and t[0] == ':backup:' and t[1] >= end: break
+                if len(t) == 2: meta[t[0]] = t[1]
+                continue
+            i = l.find('"sha1": "')
+            if i >= 0 and l[i+9:i+49] in sha1s:
+                name, o = json.loads(l)
+                names[o['sha1']] = (name, o)
+                owner[name] = o['sha1']
+            elif i < 0 and not '{' in l: # deletion
+                name = json.loads(l)[0]
+                if name in owner and names.get(owner[name], (None,))[0] == name:
+                    del names[owner.pop(name)]
+    return names, meta
+
 def restore(args):
-    """Restore backup based on Fileson DB and backup log."""
+    """Restore backup (or a part of it) based on Fileson DB and backup log.
+
+    Blobs are fetched concurrently ahead of the files being finished in
+    path order, each SHA1 only once. Files that were hard links of each
+    other (same 'hardlink' id) are linked again, other files with the
+    same content are copied. Holes of sparse files are recreated.
+    """
     fs = Fileson.load(args.dbfile)
     if fs.get(':checksum:', None) != 'sha1':
         print('Cannot restore without SHA1 hash.')
         return
 
-    log = Fileson.load(args.logfile)
+    files, dirs = restore_selection(fs, args.paths)
+    files = [p for p in files if 'sha1' in fs[p]]
+    names, meta = blob_names(args.logfile, {fs[p]['sha1'] for p in files})
 
-    if args.keyfile:
-        key = key_or_file(args.keyfile)
-        myargs = namedtuple('myargs', 'input output key verbose force')
-        make_restore = lambda a,b: decrypt(myargs(a, b, key, False, True))
+    key = key_or_file(args.keyfile) if args.keyfile else None
+    if key:
         keyhash = sha1(key).hex()
-        if keyhash != log[':keyhash:']:
+        if keyhash != meta.get(':keyhash:', None):
             print(f'Provided key hash {keyhash} does not match backup file!')
             return
-    else: make_restore = lambda a,b: shutil.copyfile(a, b)
 
-    uploaded = { log[p]['sha1']: p for p in log.files() }
-    for p in sorted(fs.dirs()):
+    loc = s3_location(args.source)
+    def fetch(b, o, fp):
+        def sink(): # data extents go back to place, leaving holes
+            if 'extents' in o: return sparse.ExtentWriter(fp, o['extents'], o['size'])
+            return open(fp, 'wb')
+        with metrics.timer('restore_seconds', 'Restore time per file'):
+            if loc:
+                bucket, folder = loc
+                with AESFile(sink(), 'wb', key) if key else sink() as f:
+                    s3_client().download_fileobj(bucket, folder+'/'+b, f)
+            elif key or 'extents' in o:
+                with open(os.path.join(args.source, b), 'rb') as fin, \
+                        AESFile(sink(), 'wb', key) if key else sink() as fout:
+                    cryptfile(fin, fout)
+            else: shutil.copyfile(os.path.join(args.source, b), fp)
+
+    for p in sorted(dirs):
         fp = args.destination
         if p != '.': fp = os.path.join(fp, p)
         print('mkdir', fp)
-        if not simulate:
-            os.makedirs(fp, exist_ok=True)
-            mtime = gmt_epoch(fs[p]['modified_gmt'])
-            os.utime(fp, (mtime, mtime))
-
-    for p in sorted(fs.files()):
-        b = uploaded.get(fs[p]['sha1'], None)
-        if not b:
-            print('Missing', p, fs[p])
-            continue
-        fp = os.path.join(args.destination, p)
-        bp = os.path.join(args.source, b)
-        print('get', fp, 'from', bp)
-        if not simulate:
-            make_restore(bp, fp)
-            mtime = gmt_epoch(fs[p]['modified_gmt'])
-            os.utime(fp, (mtime, mtime))
-restore.args = 'dbfile logfile source destination keyfile verbose simulate'.split() # args to add
+        if not args.simulate: os.makedirs(fp, exist_ok=True)
+
+    first = {} # sha1: (path, future) of the one fetched
+    linked = {} # hardlink id: first path restored with it
+    def finish(p, fp):
+        o = fs[p]
+        src, future = first[o['sha1']]
+        if future: future.result()
+        h = o.get('hardlink', None)
+        if h and linked.setdefault(h, p) != p and fs[linked[h]]['sha1'] == o['sha1']:
+            src = linked[h]
+            print('link', fp, 'to', src)
+            if args.simulate: return
+            try:
+                if os.path.exists(fp): os.remove(fp)
+                os.link(os.path.join(args.destination, src), fp)
+            except OSError: sparse.copy(os.path.join(args.destination, src), fp)
+        elif src != p:
+            print('copy', fp, 'from', src)
+            if args.simulate: return
+            sparse.copy(os.path.join(args.destination, src), fp)
+        if args.simulate: return
+        metrics.counter('restore_files', 'Files restored').inc()
+        metrics.counter('restore_bytes', 'Bytes restored').inc(o['size'])
+        mtime = gmt_epoch(o['modified_gmt'])
+        os.utime(fp, (mtime, mtime))
+
+    window = deque() # files with fetches in flight, finished in order
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        for p in sorted(files):
+            sha = fs[p]['sha1']
+            if not sha in names:
+                print('Missing', p, fs[p])
+                continue
+            b, o = names[sha]
+            fp = os.path.join(args.destination, p)
+            if not args.simulate: os.makedirs(os.path.dirname(fp), exist_ok=True)
+            if sha not in first:
+                print('get', fp, 'from', b)
+                first[sha] = (p, None if args.simulate else pool.submit(fetch, b, o, fp))
+            window.append((p, fp))
+            while len(window) > 4 * args.jobs: finish(*window.popleft())
+        while window: finish(*window.popleft())
+
+    if args.simulate: return
+    for p in sorted(dirs, reverse=True): # children first, after files written
+        fp = args.destination if p == '.' else os.path.join(args.destination, p)
+        mtime = gmt_epoch(fs[p]['modified_gmt'])
+        os.utime(fp, (mtime, mtime))
+restore.args = 'dbfile logfile source destination paths keyfile jobs verbose simulate'.split() # args to add
 
 if __name__ == "__main__":
     # These are the different argument types that can be added to a command
@@ -317,15 +864,43 @@ if __name__ == "__main__":
     'iv': lambda p: p.add_argument('--iv', type=str,
         help='Initial value (IV) for AES256 encryption, 32 hexes'),
     'iterations': lambda p: p.add_argument('-i', '--iterations', type=str,
-        default='1M', help='PBKDF2 iterations (default 1M)'),
+        default=None, help='PBKDF2 iterations (default 1M) or scrypt log2(N) (default 17)'),
+    'kdf': lambda p: p.add_argument('--kdf', type=str, default='pbkdf2',
+        choices=KDF.keys(), help='Key derivation function (default pbkdf2)'),
+    'calibrate': lambda p: p.add_argument('--calibrate', type=float, default=None,
+        help='Print cost for the KDF to take this many seconds, no key'),
     'dbfile': lambda p: p.add_argument('dbfile', type=str,
         help='Database file (JSON format)'),
     'logfile': lambda p: p.add_argument('logfile', type=str,
         help='Logfile to append all operations to'),
+    'bwlimit': lambda p: p.add_argument('-l', '--bwlimit', type=str, default=None,
+        help='Limit S3 transfer speed in bytes/s, e.g. 500k or 10M'),
+    'concurrency': lambda p: p.add_argument('-C', '--concurrency', type=str,
+        default='auto', help='S3 transfer threads, or auto to adapt (default)'),
+    'index': lambda p: p.add_argument('-x', '--index', type=str, default=None,
+        help='Shared blob index to deduplicate against other backup logs'),
+    'dbfiles': lambda p: p.add_argument('dbfiles', type=str, nargs='+',
+        help='Database files whose files are kept in backup'),
+    'keep': lambda p: p.add_argument('-n', '--keep', type=int, default=1,
+        help='Keep files of this many latest scans (default 1)'),
+    'since': lambda p: p.add_argument('--since', type=str, default=None,
+        help='Keep files of scans current at or after YYYY-MM-DD'),
+    'batch': lambda p: p.add_argument('-b', '--batch', type=int, default=1000,
+        help='Objects per delete request (default and S3 max 1000)'),
+    'sample': lambda p: p.add_argument('-s', '--sample', type=float, default=0,
+        help='Percentage of blobs to check a random range of against source'),
+    'rangesize': lambda p: p.add_argument('--rangesize', type=int, default=1024,
+        help='Size of sampled range in KiB (default 1024)'),
+    'jobs': lambda p: p.add_argument('-j', '--jobs', type=int, default=16,
+        help='Concurrent transfers, listings and checks (default 16)'),
+    'reupload': lambda p: p.add_argument('-r', '--reupload', action='store_true',
+        help='Upload missing and mismatching blobs again from source'),
     'simulate': lambda p: p.add_argument('-i', '--simulate', action='store_true',
         help='Simulate only (no saving)'),
     'source': lambda p: p.add_argument('source', type=str,
-        help='Source directory'),
+        help='Source directory or s3://bucket/folder'),
+    'paths': lambda p: p.add_argument('paths', type=str, nargs='*',
+        help='Path prefixes or globs to restore (default everything)'),
     'destination': lambda p: p.add_argument('destination', type=str,
         help='Destination directory'),
     'dir': lambda p: p.add_argument('dir', nargs='?', type=str, default=None,
@@ -340,6 +915,7 @@ if __name__ == "__main__":
 
     # create the top-level parser
     parser = argparse.ArgumentParser(description='Fileson backup utilities')
+    metrics.add_arguments(parser)
     subparsers = parser.add_subparsers(help='sub-command help')
 
     # add commands using function metadata and properties
@@ -353,4 +929,10 @@ if __name__ == "__main__":
     # parse the args and call whatever function was selected
     args = parser.parse_args()
     if len(sys.argv)==1: parser.print_help(sys.stderr)
-    else: args.func(args)
+    else:
+        if args.metrics or args.metrics_port:
+            metrics.start(args.metrics, args.metrics_port)
+        try:
+            if args.profile: metrics.profile(args.func, args, args.profile)
+            else: args.func(args)
+        finally: metrics.stop()
@@ -1,15 +1,15 @@
 #!/usr/bin/env python3
-from collections import namedtuple
-import argparse, configparser, csv, datetime, inspect, os, sys
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import argparse, configparser, csv, datetime, inspect, os, sys, threading, time
 
 from fileson import Fileson
+import metrics
 from fileson_util import scan as util_scan, summary as util_summary
 from fileson_backup import backup as util_backup, etag as util_etag
+from throttle import limit_globally
 
-config = configparser.ConfigParser()
-if not config.read('fileson.ini'):
-    print('You need to create a fileson.ini in this directory first!')
-    sys.exit(-1)
+config = configparser.ConfigParser() # read in main, not on import
 
 # Function per command
 def check(args):
@@ -29,63 +29,132 @@ def check(args):
            if os.path.isfile(logfile) else 'missing!')
         if 'skip' in conf:
             print('Skip', conf['skip'].split('\n'))
+        if 'blobstore' in conf:
+            print('Shared blob store', conf['blobstore'], 'indexed in',
+                    conf.get('blobindex', 'blobstore.log'))
         
         print()
 check.args = 'entry verbose'.split() # args to add
 
 def summary(args):
-    """Show the latest scan summary"""
+    """Show the latest (or an earlier) scan summary"""
     # Just print out the entry initially
     myargs = namedtuple('myargs', 'dbfile')
+    back = f'~{args.back}' if args.back else ''
     if args.entry:
-        util_summary(myargs(f'{args.entry}.fson'))
+        util_summary(myargs(f'{args.entry}.fson{back}'))
     else: # or all entries
         for entry in config.sections():
             print(f'[{entry}]')
-            util_summary(myargs(f'{entry}.fson'))
+            util_summary(myargs(f'{entry}.fson{back}'))
             print()
-summary.args = 'entry'.split() # args to add
+summary.args = 'entry back'.split() # args to add
+
+def entry_device(entry):
+    """Return device id of entry folder (or entry name if missing)."""
+    try: return os.stat(config[entry]['folder']).st_dev
+    except OSError: return entry # missing folder, let the command complain
+
+def run_entries(entries, work, jobs=1, group=None, out=None):
+    """Run work(entry) for all entries, at most jobs at the same time.
+
+    Entries are grouped by device of their folder (or the given group
+    function), and entries of a group run one after another so a single
+    disk does not get thrashed by parallel reads. With jobs=1 the entries
+    are just processed in order. In parallel, the start, end and failure
+    of each entry are reported to out (default sys.stdout) prefixed with
+    its name.
+
+    Returns:
+        list: Entries that failed (only in parallel, otherwise they raise)
+    """
+    if jobs <= 1:
+        for entry in entries: work(entry)
+        return []
+
+    groups = defaultdict(list)
+    for entry in entries: groups[(group or entry_device)(entry)].append(entry)
+
+    out, lock, failed = out or sys.stdout, threading.Lock(), []
+    def report(entry, *msg):
+        with lock: print(f'[{entry}]', *msg, file=out, flush=True)
+    def run_group(names):
+        for entry in names:
+            report(entry, 'Started')
+            start = time.time()
+            try: work(entry)
+            except Exception as e:
+                report(entry, 'Failed:', repr(e))
+                with lock: failed.append(entry)
+            else: report(entry, f'Done in {time.time()-start:.1f}s')
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(run_group, groups.values()))
+    return failed
 
 def scan(args):
     """Scan one entry or all."""
-    for entry in args.entry or config.sections():
+    def scan_entry(entry):
         conf = config[entry]
         fileson = f'{entry}.fson'
         skip = conf['skip'].split('\n') if 'skip' in conf else []
         strict = config.getboolean(entry, 'strict', fallback=False)
         checksum = conf.get('checksum', 'sha1')
+        scanner = conf.get('scanner', 'sync')
+        workers = config.getint(entry, 'workers', fallback=16)
+        cache = conf.get('cache', None)
         
         print(f'Scanning {entry}...')
 
-        myargs = namedtuple('myargs', 'dbfile dir checksum simulate skip strict verbose')
-        util_scan(myargs(fileson, config[entry]['folder'], checksum, False, skip, strict, args.verbose))
+        myargs = namedtuple('myargs', 'dbfile dir checksum simulate skip strict scanner workers cache verbose')
+        util_scan(myargs(fileson, config[entry]['folder'], checksum, False, skip, strict,
+            scanner, workers, cache, args.verbose))
         
         # If verbose is set, print out the summary as well
         if args.verbose:
             myargs = namedtuple('myargs', 'dbfile')
             util_summary(myargs(fileson))
-scan.args = 'entry verbose'.split() # args to add
+    failed = run_entries(args.entry or config.sections(), scan_entry, args.jobs)
+    if failed: sys.exit(f'Failed entries: {", ".join(failed)}')
+scan.args = 'entry jobs verbose'.split() # args to add
 
 def backup(args):
     """Backup one entry or all."""
-    for entry in args.entry or config.sections():
+    def backup_entry(entry):
         conf = config[entry]
         fileson = f'{entry}.fson'
         logfile = f'{entry}.log'
         destination = conf['destination']
         keyfile = conf['key']
         deep_archive = config.getboolean(entry, 'deep_archive', fallback=False)
+        bwlimit = args.bwlimit or conf.get('bwlimit', None)
+        concurrency = args.concurrency or conf.get('concurrency', 'auto')
+        index = None
         
+        # Shared blob store replaces per-entry destination
+        if 'blobstore' in conf:
+            destination = conf['blobstore']
+            index = conf.get('blobindex', 'blobstore.log')
+
         destination = destination.replace('$ENTRY$', entry)
         destination = destination.replace('$DATE$', str(datetime.datetime.today()).split()[0])
 
-        myargs = namedtuple('myargs', 'dbfile logfile destination keyfile deep_archive simulate verbose')
-        args = myargs(fileson, logfile, destination, keyfile, deep_archive, args.simulate, args.verbose)
+        myargs = namedtuple('myargs', 'dbfile logfile destination keyfile deep_archive index bwlimit concurrency simulate verbose')
+        bargs = myargs(fileson, logfile, destination, keyfile, deep_archive,
+                index, bwlimit, concurrency, args.simulate, args.verbose)
         
         print(f'Backing up {entry} to {destination}...')
-        if args.verbose > 1: print(args)
-        util_backup(args)
-backup.args = 'entry simulate verbose'.split() # args to add
+        if args.verbose > 1: print(bargs)
+        util_backup(bargs)
+
+    limit_globally(args.global_bwlimit or config.defaults().get('global_bwlimit'))
+
+    # Entries sharing a blob index must not update it at the same time
+    group = lambda e: config[e].get('blobindex', 'blobstore.log') \
+            if 'blobstore' in config[e] else entry_device(e)
+    failed = run_entries(args.entry or config.sections(), backup_entry,
+            min(args.jobs, args.uploads), group)
+    if failed: sys.exit(f'Failed entries: {", ".join(failed)}')
+backup.args = 'entry jobs uploads bwlimit global_bwlimit concurrency simulate verbose'.split() # args to add
 
 def etag(args):
     """Check ETAG checksums of backed up files."""
@@ -121,6 +190,8 @@ if __name__ == "__main__":
         help='Backup entry in fileson.ini'),
     'entry': lambda p: p.add_argument('-e', '--entry', type=str, nargs='?', action='append',
         help='Backup entry (repeat for multiple) in fileson.ini'),
+    'back': lambda p: p.add_argument('-b', '--back', type=int, default=0,
+        help='Show the scan N scans before the latest one'),
     'verbose': lambda p: p.add_argument('-v', '--verbose', action='count',
         default=0, help='Print verbose status. Repeat for even more.'),
     'force': lambda p: p.add_argument('-f', '--force', action='store_true',
@@ -129,10 +200,21 @@ if __name__ == "__main__":
         default=None, help='Multipart upload partsize (default 8 matching boto3)'),
     'simulate': lambda p: p.add_argument('-i', '--simulate', action='store_true',
         help='Simulate only (no saving)'),
+    'bwlimit': lambda p: p.add_argument('-l', '--bwlimit', type=str, default=None,
+        help='Limit S3 transfer speed per entry in bytes/s, e.g. 500k or 10M'),
+    'global_bwlimit': lambda p: p.add_argument('-L', '--global-bwlimit', type=str,
+        default=None, help='Limit total S3 transfer speed of all entries'),
+    'concurrency': lambda p: p.add_argument('-C', '--concurrency', type=str,
+        default=None, help='S3 transfer threads, or auto to adapt (default)'),
+    'jobs': lambda p: p.add_argument('-j', '--jobs', type=int, default=1,
+        help='Entries on different disks to process in parallel (default 1)'),
+    'uploads': lambda p: p.add_argument('-u', '--uploads', type=int, default=2,
+        help='Maximum parallel uploading entries (default 2)'),
             }
 
     # create the top-level parser
     parser = argparse.ArgumentParser(description='Fileson backup tool')
+    metrics.add_arguments(parser)
     subparsers = parser.add_subparsers(help='sub-command help')
 
     # add commands using function metadata and properties
@@ -146,4 +228,13 @@ if __name__ == "__main__":
     # parse the args and call whatever function was selected
     args = parser.parse_args()
     if len(sys.argv)==1: parser.print_help(sys.stderr)
-    else: args.func(args)
+    elif not config.read('fileson.ini'):
+        print('You need to create a fileson.ini in this directory first!')
+        sys.exit(-1)
+    else:
+        if args.metrics or args.metrics_port:
+            metrics.start(args.metrics, args.metrics_port)
+        try:
+            if args.profile: metrics.profile(args.func, args, args.profile)
+            else: args.func(args)
+        finally: metrics.stop()
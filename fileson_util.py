@@ -1,61 +1,153 @@
 #!/usr/bin/env python3
-from collections import defaultdict
-from fileson import Fileson
-import argparse, os, sys, json, random, inspect
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fileson import Fileson, gmt_str
+from operator import itemgetter
+from query import Query, QueryError, fields, query_sqlite, stream
+from throttle import limiter
+import extsort, metrics
+import argparse, os, sys, json, random, inspect, time, tempfile, shutil, itertools, csv
+
+scrub_bytes = metrics.counter('scrub_bytes', 'Bytes read to verify checksums')
+
+def _spill_files(db_or_dir, entry, minsize, checksum, cache, tmpdir, partitions):
+    """Write (size, checksum, entry, path) of files to partition files.
+
+    Run in a worker process per DB or directory. Files are partitioned
+    by size, so possible duplicates always land in the same partition.
+    Returns the checksum type and number of files written.
+    """
+    fs = Fileson.load_or_scan(db_or_dir, checksum=checksum, cache=cache)
+    ctype = fs.get(':checksum:', None)
+    outs = [open(os.path.join(tmpdir, f'{entry}-{i}.jsonl'), 'w', encoding='utf8')
+            for i in range(partitions)]
+    n = 0
+    for p in fs.files():
+        o = fs[p]
+        if o['size'] < minsize: continue
+        out = outs[o['size'] % partitions]
+        json.dump((o['size'], o.get(ctype, None) if ctype else None, entry, p), out)
+        out.write('\n')
+        n += 1
+    for out in outs: out.close()
+    return ctype, n
 
 # Function per command
 def duplicates(args):
-    """Look for duplicates using Fileson DB."""
-    minsize = int(args.minsize.replace('G', '000M').replace('M', '000k').replace('k', '000'))
-
-    fs = Fileson.load_or_scan(args.db_or_dir, checksum=args.checksum)
-    files = [(p,fs[p]) for p in fs.files() if fs[p]['size'] >= minsize]
-    checksum = fs.get(':checksum:', None) or 'size'
-
-    if checksum == 'size': print('No checksum, using file size!')
-        
-    csums = defaultdict(list)
-    for p,o in files: csums[o[checksum]].append(p)
+    """Look for duplicates in one or more Fileson DBs (or directories).
 
-    for csum,ps in csums.items():
-        if len(ps)>1: print(csum, *ps, sep='\n')
-duplicates.args = 'db_or_dir minsize checksum'.split() # args to add
+    Databases are loaded in parallel processes and their files spilled
+    to disk partitioned by size, so only one partition of all files is
+    in memory at a time when grouping. With several inputs, wasted bytes
+    are reported per pair of inputs.
+    """
+    minsize = int(args.minsize.replace('G', '000M').replace('M', '000k').replace('k', '000'))
+    inputs = args.dbs_or_dirs
+    tmpdir = tempfile.mkdtemp(prefix='fileson-dups-')
+    try:
+        work = [(d, i, minsize, args.checksum, args.cache, tmpdir, args.partitions)
+                for i,d in enumerate(inputs)]
+        if args.processes > 1 and len(inputs) > 1:
+            with ProcessPoolExecutor(max_workers=args.processes) as pool:
+                res = list(pool.map(_spill_files, *zip(*work)))
+        else: res = [_spill_files(*w) for w in work]
+
+        # Checksums are only comparable if all inputs have the same kind
+        types = {t for t,_ in res}
+        checksum = types.pop() if len(types) == 1 else 'size'
+        if checksum in (None, 'none'): checksum = 'size'
+        if checksum == 'size':
+            print('No common checksum, using file size!' if len(types) else
+                    'No checksum, using file size!')
+        if args.verbose: print(sum(n for _,n in res), 'files in', len(inputs), 'inputs')
+
+        pairs = defaultdict(int)
+        for part in range(args.partitions):
+            def records():
+                for i in range(len(inputs)):
+                    with open(os.path.join(tmpdir, f'{i}-{part}.jsonl'), encoding='utf8') as fin:
+                        for l in fin:
+                            size, csum, entry, p = json.loads(l)
+                            if checksum == 'size': yield (size, entry, p, size)
+                            elif csum: yield (csum, entry, p, size)
+
+            for csum,ps in extsort.groupby(records(), itemgetter(0), args.sortmem):
+                if len(ps) < 2: continue
+                ps = [tuple(r[1:]) for r in ps]
+                size = ps[0][2]
+                print(csum)
+                counts = defaultdict(int)
+                for entry,p,_ in sorted(ps):
+                    print(p if len(inputs) == 1 else f'{inputs[entry]}: {p}')
+                    counts[entry] += 1
+                # Extra copies within an input, and one copy per other input
+                for a in counts:
+                    pairs[(a, a)] += size * (counts[a]-1)
+                    for b in counts:
+                        if a < b: pairs[(a, b)] += size
+    finally: shutil.rmtree(tmpdir)
+
+    if len(inputs) > 1:
+        print('Wasted by input pair:')
+        for (a,b),w in sorted(pairs.items(), key=lambda x: -x[1]):
+            if w: print(f'{format_size(w):>12}', inputs[a], 'within' if a == b else f'<-> {inputs[b]}')
+duplicates.args = 'dbs_or_dirs minsize checksum cache processes partitions sortmem verbose'.split() # args to add
 
 def show(args):
     """Show files in a Fileson DB."""
     fs = Fileson.load(args.dbfile)
 
+    files = sorted(fs.files()) if args.sort else fs.files()
     if args.verbose:
         fields = ['size', 'modified_gmt', 'sha1']
-        for p in fs.files():
+        for p in files:
             values = [fs[p][f]  if f in fs[p] else '' for f in fields]
             print(p, *(f'{k} {v}' for k,v in zip(fields, values)))
     else:
-        for p in fs.files(): print(p)
-show.args = ['dbfile', 'verbose'] # args to add
+        for p in files: print(p)
+show.args = ['dbfile', 'sort', 'verbose'] # args to add
 
 def stats(args):
     """Show statistics of a Fileson DB."""
-    fs = Fileson.load_or_scan(args.db_or_dir)
+    stats = None
+    if not args.verbose and not os.path.isdir(args.db_or_dir): # recorded at the end of scan
+        stats = Fileson.scan_summary(args.db_or_dir)[2]
+    if not stats:
+        fs = Fileson.load_or_scan(args.db_or_dir)
+        stats = fs.stats() or fs.scan_stats({}, 0)
 
-    print(len(fs.files()), 'files', len(fs.dirs()), 'directories')
+    print(stats['files'], 'files', stats['dirs'], 'directories')
 
     if args.verbose:
         print('Metadata history:')
         for i,t in enumerate(fs.log):
             if len(t)==2 and t[0][0]==':': print(f'{i:05d}: {t[0]:12s} {t[1]}')
 
-    dirs = list(fs.dirs())
-    if dirs: print('Max dir depth', max(p.count(os.sep) for p in dirs))
+    if stats['dirs']: print('Max dir depth', stats['depth'])
 
-    files = list(fs.files())
-    if files:
-        print('Total file size %.2f GiB' %
-                (sum(fs[p]['size'] for p in files)/2**30))
-        print('Max file size %.3f GiB' % 
-                (max(fs[p]['size'] for p in files)/2**30))
+    if stats['files']:
+        print('Total file size %.2f GiB' % (stats['bytes']/2**30))
+        print('Max file size %.3f GiB' % (stats['max_size']/2**30))
+
+    if args.verbose:
+        print('File size histogram:')
+        for i,n in enumerate(stats['histogram']):
+            if n: print(f'{format_size(2**i // 2):>12} - {format_size(2**i):<12}', n)
 stats.args = ['db_or_dir', 'verbose'] # args to add
 
+def du(args):
+    """Show file counts and total sizes per directory, largest first."""
+    fs = Fileson.load_or_scan(args.db_or_dir)
+    prefix = os.path.normpath(args.path) if args.path else '.'
+
+    rows = [(fs.index.stats(p), p) for p in fs.index.dirs(prefix, args.depth)]
+    rows.sort(key=lambda r: r[0][2], reverse=True)
+    for (files, dirs, size), p in rows:
+        print(f'{format_size(size):>12} {files:9d} files {dirs:7d} dirs  {p}')
+    files, dirs, size = fs.index.stats(prefix)
+    print(f'{format_size(size):>12} {files:9d} files {dirs:7d} dirs  total')
+du.args = 'db_or_dir path depth'.split() # args to add
+
 def format_size(size):
     """Return human readable size."""
     if size > 2**30: return f'{size/2**30:.2f} GiB'
@@ -64,65 +156,47 @@ def format_size(size):
     else: return f'{size} B'
 
 def summary(args):
-    """Show summary of the latest scan in Fileson DB."""
-    fs = Fileson.load(args.dbfile)
-
-    last_scan = fs.get(':scan:', 0)
+    """Show summary of the latest scan (or db.fson~N) in Fileson DB."""
+    entries, last_scan, stats = Fileson.scan_summary(args.dbfile)
     
     if last_scan == 0:
         print('No scan has been run yet!')
         return
 
-    print(len(fs.log), 'entries', last_scan, 'scans')
+    print(entries, 'entries', last_scan, 'scans')
 
-    # Make a slice of the log before the last scan, and the last scan
-    fs_initial = fs.slice(end=(':scan:', last_scan)) # stop is exclusive
-    fs_last = fs.slice(start=(':scan:', last_scan))
-    
-    print('Initial log size', len(fs_initial.log), 'last scan size', len(fs_last.log))
-    
-    # Loop through all files in the last scan and compare to initial
-    # to detect modified, added and deleted files on top level directory level
-    counts = defaultdict(lambda: defaultdict(int))
-    sizes = defaultdict(lambda: defaultdict(int))
-    dirs = set()
-    for entry in fs_last.log:
-        if entry[0][0] == ':': continue # skip metadata
+    if stats: # recorded at the end of scan
+        changes = stats['changes']
+        print('Initial log size', entries-stats['ops'], 'last scan size', stats['ops'])
+    else:
+        fs = Fileson.load(args.dbfile)
+        start = fs.log.index((':scan:', last_scan))
+        scrubs = [t[0] == ':scrub:' for t in fs.log] # not part of scans
+        print('Initial log size', start - sum(scrubs[:start]),
+                'last scan size', len(fs.log) - start - sum(scrubs[start:]))
         
-        if len(entry)==2: # add or update
-            p, data = entry
-            topdir = p.split(os.path.sep)[0] # top level directory
-            dirs.add(topdir)
-            if p in fs_initial:
-                counts[topdir]['modified'] += 1
-                sizes[topdir]['modified'] += data.get('size', 0)
-            else:
-                counts[topdir]['added'] += 1
-                sizes[topdir]['added'] += data.get('size', 0)
-
-        else: # delete
-            p = entry[0]
-            topdir = p.split(os.path.sep)[0] # top level directory
-            dirs.add(topdir)
-            data = fs_initial[p]
-            counts[topdir]['deleted'] += 1
-            sizes[topdir]['deleted'] += fs_initial[p].get('size', 0)
-
-    # Sum up sizes per directory
-    dirsizes = [(d, sum(sizes[d].values())) for d in dirs]
+        # Detect modified, added and deleted files on top level directory level
+        changes = {}
+        for p,old,new in fs.changes(): Fileson.count_change(changes, p, old, new)
 
     # Sort directories by change size (descending)
+    dirsizes = [(d, sum(s for _,s in kinds.values())) for d,kinds in changes.items()]
     dirsizes.sort(key=lambda x: x[1], reverse=True)
     for d,_ in dirsizes:
-        cnt = counts[d]
         # Do ANSI escapes for colors: light red for deleted, light green for added, light blue for modified
         escapes = {'deleted': '\033[91m', 'added': '\033[92m', 'modified': '\033[94m'}
-        str = ", ".join(f'{escapes[k]}{cnt[k]} {k} {format_size(v)}\033[0m' for k,v in sizes[d].items())
+        str = ", ".join(f'{escapes[k]}{n} {k} {format_size(v)}\033[0m' for k,(n,v) in changes[d].items())
         print(f'{d}: {str}')
 summary.args = ['dbfile'] # args to add
 
 def checksum(args):
-    """Change or re-run checksums for a Fileson DB."""
+    """Verify (scrub) checksums of files in a Fileson DB.
+
+    Files are read in inode order, which on most filesystems is close
+    to disk order. With --resume, each run continues where the previous
+    one stopped, so a full pass can be spread over many runs. A :scrub:
+    record with results is appended to the DB after every run.
+    """
     fs = Fileson.load(args.dbfile)
     checksum = fs.get(':checksum:', None)
     if not checksum:
@@ -138,52 +212,156 @@ def checksum(args):
 
     files = fs.files()
     n = args.percent * len(files) // 100
-    files = random.sample(files, k=n)
-
-    if args.verbose: print('Rechecking', n, 'files\' checksums')
-    csummer = Fileson.summer[checksum]
+    last = fs.get(':scrub:', {})
+    cursor = last.get('cursor', None)
+    if not args.resume: files = random.sample(files, k=n)
+
+    # Order by inode for sequential reads, stat calls in parallel as well
+    def stat(p):
+        try: return os.stat(os.path.join(directory, p))
+        except OSError: return None # missing
+    pool = ThreadPoolExecutor(max_workers=args.jobs)
+    stats = dict(zip(files, pool.map(stat, files)))
+    key = lambda p: [stats[p].st_ino if stats[p] else 0, p]
+    files.sort(key=key)
+    if args.resume:
+        if cursor: files = [p for p in files if key(p) > cursor]
+        more = len(files) > max(n, 1) # left for next runs
+        files = files[:max(n, 1)]
+
+    if args.verbose: print('Rechecking', len(files), 'files\' checksums')
     total = sum(fs[p]['size'] for p in files)
-    checked = 0
-
-    for p in random.sample(files, k=n):
-        f = fs[p]
-        fp = os.path.join(directory, p)
-        old = f[checksum]
-        
-        # Check if file exists
-        if not os.path.exists(fp):
-            print('MISSING', fp)
-            continue
-
-        new = csummer(fp, f)
-        checked += f['size']
-
-        # Every 1GiB passed print a status line
-        if args.verbose and \
-            checked // 2**30 != (checked - f['size']) // 2**30:
-            print('Processed', format_size(checked), 'of', format_size(total),
-                  f'({checked/total*100:.2f}%)',)
-
-        if old == new:
-            if args.verbose > 1: print('OK', fp.split(os.sep)[-1])
-        else:
-            print('FAIL', fp)
-            print(p, 'old', old, 'vs.', new, 'new')
-
-    if args.verbose: print('Total bytes', format_size(total), 'scanned.')
-checksum.args = 'dbfile percent dir force verbose'.split() # args to add
+    limit = limiter(args.bwlimit)
+    deadline = time.time() + args.hours * 3600 if args.hours else None
+
+    def verify(p):
+        f, st = fs[p], stats[p]
+        if st is None: return 'missing'
+        if st.st_size != f['size'] or gmt_str(st.st_mtime) != f['modified_gmt'] \
+                or not f.get(checksum, None):
+            return 'changed' # since scan, can not verify
+        if deadline and time.time() > deadline: return None # out of time
+        new = Fileson.summer[checksum](os.path.join(directory, p), f, limit=limit)
+        scrub_bytes.inc(f['size'])
+        return 'ok' if new == f[checksum] else 'failed'
+
+    def results(): # a bounded window of reads in flight, none queued past deadline
+        window = deque()
+        for p in files:
+            if deadline and time.time() > deadline: break
+            window.append((p, pool.submit(verify, p)))
+            if len(window) >= 4 * args.jobs:
+                p, future = window.popleft()
+                yield p, future.result()
+        for p, future in window: yield p, future.result()
+
+    result = {'started_gmt': gmt_str(), 'checksum': checksum, 'files': 0,
+            'bytes': 0, 'changed': 0, 'failed': [], 'missing': []}
+    checked, done = 0, None
+    try:
+        for p,status in results():
+            if status is None: break
+            done = p
+            fp = os.path.join(directory, p)
+            if status == 'changed':
+                result['changed'] += 1
+                if args.verbose > 1: print('CHANGED', fp)
+                continue
+            if status == 'missing':
+                result['missing'].append(p)
+                print('MISSING', fp)
+                continue
+            size = fs[p]['size']
+            result['files'] += 1
+            result['bytes'] += size
+            checked += size
+
+            # Every 1GiB passed print a status line
+            if args.verbose and checked // 2**30 != (checked - size) // 2**30:
+                print('Processed', format_size(checked), 'of', format_size(total),
+                      f'({checked/total*100:.2f}%)',)
+
+            if status == 'ok':
+                if args.verbose > 1: print('OK', fp.split(os.sep)[-1])
+            else:
+                result['failed'].append(p)
+                print('FAIL', fp)
+                print(p, 'expected', fs[p][checksum])
+    except KeyboardInterrupt: print('Interrupted, saving progress')
+    finally: pool.shutdown(wait=False, cancel_futures=True)
+
+    # Cursor moves only when resuming, and None starts the next pass
+    if args.resume:
+        if done is None: cursor = cursor if files else None
+        else: cursor = key(done) if more or done != files[-1] else None
+    result['cursor'] = cursor
+    result['date_gmt'] = gmt_str()
+    fs.startLogging(args.dbfile)
+    fs[':scrub:'] = result
+    fs.endLogging()
+
+    if args.verbose: print('Total bytes', format_size(checked), 'scanned.')
+checksum.args = 'dbfile percent dir resume bwlimit jobs hours force verbose'.split() # args to add
 
 def diff(args):
     """Show difference between two Fileson objects (or directories)."""
-    src = Fileson.load_or_scan(args.src)
-    dest = Fileson.load_or_scan(args.dest)
-    for p in sorted(set(src) | set(dest)):
+    (srcfile, srcback), (destfile, destback) = map(Fileson.history, (args.src, args.dest))
+    if srcfile == destfile and os.path.isfile(srcfile): # versions of same DB
+        fs = Fileson.load(srcfile)
+        scans = fs.get(':scan:', 0)
+        if max(srcback, destback) > scans:
+            raise ValueError(f'{srcfile} has {scans} scans, cannot go {max(srcback, destback)} back')
+        a, b = (max(scans - back, 0) for back in (srcback, destback))
+        if a == b: changes = () # same version
+        elif a < b: changes = fs.changes(a+1, b)
+        else: changes = ((p,s,d) for p,d,s in fs.changes(b+1, a))
+        for p,s,d in sorted(changes, key=itemgetter(0)):
+            json.dump({'path': p, 'src': s, 'dest': d}, args.delta, default=dict)
+            args.delta.write('\n')
+        return
+
+    # Directories are scanned with the checksum of the DB they are compared to
+    dbs = {p: Fileson.load(p) for p in (args.src, args.dest) if not os.path.isdir(p)}
+    checksum = next(iter(dbs.values())).get(':checksum:', None) if dbs else None
+    src, dest = (dbs[p] if p in dbs else Fileson.load_or_scan(p, checksum=checksum,
+        cache=args.cache) for p in (args.src, args.dest))
+    for p in sorted(itertools.chain(src, (p for p in dest if p not in src))):
         s = src.get(p, None)
         d = dest.get(p, None)
         if p[0] != ':' and s != d:
-            json.dump({'path': p, 'src': s, 'dest': d}, args.delta)
+            json.dump({'path': p, 'src': s, 'dest': d}, args.delta, default=dict)
             args.delta.write('\n')
-diff.args = 'src dest delta'.split() # args to add
+diff.args = 'src dest delta cache'.split() # args to add
+
+def query(args):
+    """Find entries matching an expression in a Fileson (or fson2sqlite) DB."""
+    backups = None
+    if args.log:
+        log = Fileson.load(args.log)
+        backups = {log[p]['sha1'] for p in log.files() if 'sha1' in log[p]}
+    try: q = Query(args.expression, backups)
+    except QueryError as e:
+        print('Invalid query:', e)
+        return
+
+    dbfile, back = Fileson.history(args.dbfile)
+    with open(dbfile, 'rb') as f: sqlite = f.read(16) == b'SQLite format 3\0'
+    if sqlite: rows = query_sqlite(dbfile, q)
+    else: rows = ((None, p, r, s) for p,r,s in stream(dbfile, q, back))
+
+    columns = ['path', 'type', 'size', 'mtime', 'checksum', 'scan'] + \
+            (['backup'] if backups is not None else []) + (['entry'] if sqlite else [])
+    if args.format == 'csv':
+        writer = csv.writer(args.output)
+        writer.writerow(columns)
+    for entry,p,r,s in rows:
+        f = fields(p, r, s, backups)
+        f['entry'] = entry
+        if args.format == 'csv': writer.writerow([f[c] for c in columns])
+        else:
+            json.dump({c: f[c] for c in columns}, args.output)
+            args.output.write('\n')
+query.args = 'dbfile expression format log output'.split() # args to add
 
 def copy(args):
     """Make a copy of (specified version of the) database."""
@@ -193,6 +371,30 @@ def copy(args):
         fs.save(args.dest)
 copy.args = 'src dest force'.split() # args to add
 
+def compact(args):
+    """Drop history between retained versions of a Fileson DB (or backup log)."""
+    tmpfile = args.dbfile + '.compact'
+    versions, lines, written = Fileson.compact(args.dbfile, tmpfile,
+            args.keep, args.monthly)
+    print(f'Keeping {len(versions)} versions, {lines} lines to {written}')
+    if args.verbose: print('Retained:', *versions)
+    if args.simulate: os.remove(tmpfile)
+    else:
+        with open(tmpfile, 'rb+') as f: os.fsync(f.fileno())
+        os.replace(tmpfile, args.dbfile) # atomic
+compact.args = 'dbfile keep monthly simulate verbose'.split() # args to add
+
+def restat(args):
+    """Rebuild aggregate statistics of all scans in a Fileson DB."""
+    fs = Fileson.load(args.dbfile)
+    new = fs.restat()
+    if args.verbose: print('Rebuilt stats of', new.get(':scan:', 0), 'scans')
+    if args.simulate: return
+    tmpfile = args.dbfile + '.tmp'
+    new.save(tmpfile)
+    os.replace(tmpfile, args.dbfile)
+restat.args = 'dbfile simulate verbose'.split() # args to add
+
 def scan(args):
     """Create fileson JSON file database."""
     fs = Fileson.load(args.dbfile)
@@ -215,21 +417,75 @@ def scan(args):
 
     try:
         fs.scan(args.dir, checksum=args.checksum, verbose=args.verbose,
-                strict=args.strict, skip=args.skip)
+                strict=args.strict, skip=args.skip,
+                scanner=args.scanner, workers=args.workers, cache=args.cache)
     except KeyboardInterrupt:
         print('Aborted while backing up. Restart later to continue')
 
     if not args.simulate: fs.endLogging()
-scan.args = 'dbfile dir checksum simulate skip strict verbose'.split() # args to add
+scan.args = 'dbfile dir checksum simulate skip strict scanner workers cache verbose'.split() # args to add
+
+def watch(args):
+    """Keep Fileson DB up to date by watching changes with inotify.
+
+    A full scan is made first, after which changes are collected and
+    applied every interval seconds as a partial scan (a new version).
+    """
+    from inotify import TreeWatcher # Linux only
+    from skip import SkipMatcher
+    fs = Fileson.load(args.dbfile)
+    directory = args.dir or fs.get(':directory:', None)
+    if not directory:
+        print('No directory specified and none in DB!')
+        return
+    checksum = args.checksum or fs.get(':checksum:', None)
+    kwargs = dict(checksum=checksum, verbose=args.verbose, strict=args.strict,
+            skip=args.skip, cache=args.cache)
+
+    # Watch before scanning so no change slips between
+    watcher = TreeWatcher(directory, SkipMatcher(args.skip, directory))
+    fs.startLogging(args.dbfile)
+    try:
+        fs.scan(directory, **kwargs)
+        print('Watching', len(watcher.wds), 'directories in', directory)
+        while True:
+            watcher.read(None) # wait for something to happen
+            deadline = time.time() + args.interval
+            while time.time() < deadline: watcher.read(deadline - time.time())
+            paths, subtrees = watcher.take()
+            if not fs.scan(directory, paths=paths, subtrees=subtrees, **kwargs):
+                if args.verbose: print('No changes') # nothing written
+            elif args.verbose:
+                changes = fs.stats()['changes']
+                n = sum(c for kinds in changes.values() for c,_ in kinds.values())
+                print(f'Scan {fs[":scan:"]}: {len(paths)} paths and',
+                        f'{len(subtrees)} subtrees checked, {n} changes')
+    except KeyboardInterrupt: print('Stopped watching')
+    finally:
+        watcher.close()
+        fs.endLogging()
+watch.args = 'dbfile dir checksum skip strict interval cache verbose'.split() # args to add
 
 if __name__ == "__main__":
     # These are the different argument types that can be added to a command
     arg_adders = {
+    'cache': lambda p: p.add_argument('--cache', type=str, default=None,
+        help='Persistent checksum cache file shared by scans (SQLite)'),
     'checksum': lambda p: p.add_argument('-c', '--checksum', type=str,
         choices=Fileson.summer.keys(), default='sha1',
         help='Checksum method (if relevant in the context)'),
     'db_or_dir': lambda p: p.add_argument('db_or_dir', type=str,
         help='Database file or directory, supports db.fson~1 history mode.'),
+    'dbs_or_dirs': lambda p: p.add_argument('dbs_or_dirs', type=str, nargs='+',
+        help='Database files or directories, supports db.fson~1 history mode.'),
+    'sort': lambda p: p.add_argument('-s', '--sort', action='store_true',
+        help='Sort by path'),
+    'sortmem': lambda p: p.add_argument('--sortmem', type=int, default=extsort.MEMORY,
+        help=f'Memory for sorting in MB before spilling to disk (default {extsort.MEMORY})'),
+    'processes': lambda p: p.add_argument('-P', '--processes', type=int, default=1,
+        help='Inputs to load and partition in parallel processes (default 1)'),
+    'partitions': lambda p: p.add_argument('-p', '--partitions', type=int, default=64,
+        help='Spill partitions, more uses less memory (default 64)'),
     'dbfile': lambda p: p.add_argument('dbfile', type=str,
         help='Database file (JSON format)'),
     'delta': lambda p: p.add_argument('delta', nargs='?',
@@ -238,14 +494,46 @@ if __name__ == "__main__":
     'dest': lambda p: p.add_argument('dest', type=str, help='Destination DB'),
     'dir': lambda p: p.add_argument('dir', nargs='?', type=str, default=None,
         help='Directory to scan'),
+    'expression': lambda p: p.add_argument('expression', type=str,
+        help="Query, e.g. \"size > 1G and mtime >= 2023 and path ~ 'Photos/**'\""),
+    'format': lambda p: p.add_argument('-f', '--format', type=str, default='jsonl',
+        choices=['jsonl', 'csv'], help='Output format (default jsonl)'),
+    'log': lambda p: p.add_argument('--log', type=str, default=None,
+        help='Backup log, enables the backup field in queries'),
+    'output': lambda p: p.add_argument('output', nargs='?',
+        type=argparse.FileType('w'), default='-',
+        help='Output file or - for stdout (default)'),
     'force': lambda p: p.add_argument('-f', '--force', action='store_true',
         help='Force action without additional prompts'),
+    'keep': lambda p: p.add_argument('-k', '--keep', type=int, default=10,
+        help='Number of latest versions to keep (default 10)'),
+    'monthly': lambda p: p.add_argument('-m', '--monthly', action='store_true',
+        help='Keep also the last version of every month'),
     'minsize': lambda p: p.add_argument('-m', '--minsize', type=str, default='0',
         help='Minimum size (e.g. 100, 10k, 1M)'),
-    'percent': lambda p: p.add_argument('percent', type=int,
-        help='Percentage of checksums to check'),
+    'path': lambda p: p.add_argument('path', nargs='?', type=str, default=None,
+        help='Directory inside the DB (default whole DB)'),
+    'depth': lambda p: p.add_argument('-d', '--depth', type=int, default=1,
+        help='Directory levels to show (default 1)'),
+    'percent': lambda p: p.add_argument('percent', nargs='?', type=int, default=100,
+        help='Percentage of checksums to check (default 100)'),
+    'resume': lambda p: p.add_argument('-r', '--resume', action='store_true',
+        help='Continue in inode order from previous run instead of random sample'),
+    'bwlimit': lambda p: p.add_argument('-l', '--bwlimit', type=str, default=None,
+        help='Read speed limit in bytes per second, e.g. 500k, 10M'),
+    'interval': lambda p: p.add_argument('-t', '--interval', type=float, default=10,
+        help='Seconds to collect changes before applying them (default 10)'),
+    'jobs': lambda p: p.add_argument('-j', '--jobs', type=int, default=1,
+        help='Files to read in parallel (default 1)'),
+    'hours': lambda p: p.add_argument('-H', '--hours', type=float, default=None,
+        help='Stop after this many hours (resume later with -r)'),
+    'scanner': lambda p: p.add_argument('-a', '--scanner', type=str,
+        choices=['sync', 'async'], default='sync',
+        help='Scanning engine, async is faster on network drives'),
+    'workers': lambda p: p.add_argument('-w', '--workers', type=int, default=16,
+        help='Concurrent file system calls for async scanner (default 16)'),
     'skip': lambda p: p.add_argument('-S', '--skip', type=str, nargs='?', action='append', default=[],
-        help='Skip files/folders based on path fragment (repeat for multiple)'),
+        help='Skip files/folders based on path fragment or glob:pattern (repeat for multiple)'),
     'src': lambda p: p.add_argument('src', type=str,
         help='Source DB, use src.fson~1 to access previous version etc.'),
     'simulate': lambda p: p.add_argument('-i', '--simulate', action='store_true',
@@ -258,6 +546,7 @@ if __name__ == "__main__":
 
     # create the top-level parser
     parser = argparse.ArgumentParser(description='Fileson database utilities')
+    metrics.add_arguments(parser)
     subparsers = parser.add_subparsers(help='sub-command help')
 
     # add commands using function metadata and properties
@@ -271,4 +560,10 @@ if __name__ == "__main__":
     # parse the args and call whatever function was selected
     args = parser.parse_args()
     if len(sys.argv)==1: parser.print_help(sys.stderr)
-    else: args.func(args)
+    else:
+        if args.metrics or args.metrics_port:
+            metrics.start(args.metrics, args.metrics_port)
+        try:
+            if args.profile: metrics.profile(args.func, args, args.profile)
+            else: args.func(args)
+        finally: metrics.stop()
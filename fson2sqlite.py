@@ -1,71 +1,209 @@
-import json, sys, sqlite3
+#!/usr/bin/env python3
+"""Import Fileson databases into SQLite for ad hoc queries.
 
-if len(sys.argv) < 3:
-    print('Usage: fson2sqlite [sqlite.db] [file.fson] ...')
-    exit(1)
+Each .fson file is parsed in a worker process into its own staging
+database, streaming the log and inserting rows in large batches. Staging
+databases are merged into the target one at a time, each in a single
+transaction. The byte offset reached in every .fson file is remembered,
+so running the import again only adds scans (and lines) appended since.
+If a file was rewritten in between, it is imported again from scratch.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from hashlib import sha1
+from urllib.parse import quote
+import argparse, json, os, sqlite3, tempfile
 
-con = sqlite3.connect(sys.argv[1])#, isolation_level=None)
-cur = con.cursor()
-
-cur.execute('''CREATE TABLE IF NOT EXISTS scans (
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scans (
     entry TEXT NOT NULL,
     date_gmt TEXT NOT NULL,
     folder TEXT NOT NULL,
-    skip TEXT DEFAULT ''
-)''')
-
-cur.execute('CREATE INDEX IF NOT EXISTS scan_entry_idx ON scans(entry, date_gmt)')
-
-# op = 0 for deletion, 1 for modification, 2 for creation
-# modified_gmt NULL for deletions
-# size NULL for directories
-# sha1 only for files
-cur.execute('''CREATE TABLE IF NOT EXISTS files (
+    checksum TEXT DEFAULT NULL,
+    meta TEXT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS scan_entry_idx ON scans(entry, date_gmt);
+CREATE TABLE IF NOT EXISTS files (
     scan_id INTEGER NOT NULL,
     filename TEXT NOT NULL,
     op INTEGER NOT NULL,
     modified_gmt TEXT DEFAULT NULL,
     size INTEGER DEFAULT NULL,
-    sha1 TEXT DEFAULT NULL
-)''')
+    checksum TEXT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS file_idx ON files(scan_id, filename);
+CREATE TABLE IF NOT EXISTS imports (
+    entry TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    tail TEXT NOT NULL,
+    scan_id INTEGER NOT NULL
+);
+'''
+# op = 0 for deletion, 1 for modification, 2 for creation
+# modified_gmt NULL for deletions, size NULL for directories and links
+# checksum (of type given in scans) only for files
+
+BATCH = 10000 # rows per executemany
+TAIL = 1024 # bytes before offset that must be unchanged to resume
+
+def tail_hash(filename: str, offset: int) -> str:
+    """Return hash of the bytes just before offset in file."""
+    with open(filename, 'rb') as f:
+        f.seek(max(0, offset - TAIL))
+        return sha1(f.read(offset - f.tell())).hexdigest()
+
+def stage(entry: str, dbfile: str, stagefile: str, state: tuple) -> tuple:
+    """Parse new lines of a .fson file into a staging database.
+
+    Runs in a worker process. New scans get rowids from 1 up in staging,
+    lines continuing the last imported scan use scan_id 0 (and its
+    updated metadata is stored as scans rowid 0).
 
-cur.execute('CREATE INDEX IF NOT EXISTS file_idx ON files(scan_id, filename)')
+    Args:
+        entry (str): The .fson file
+        dbfile (str): Target database, read for the state of a resumed import
+        stagefile (str): Staging database to create
+        state (tuple): (offset, tail, scan_id) of the last import or None
 
-for entry in sys.argv[2:]:
-    current = {} # Current state
+    Returns:
+        tuple: (entry, stagefile, offset, tail, reset, scans, rows)
+    """
+    offset, reset = 0, False
+    current, scan_id, meta = set(), None, {}
+    if state:
+        if os.path.getsize(entry) >= state[0] and tail_hash(entry, state[0]) == state[1]:
+            offset, scan_id = state[0], 0
+            con = sqlite3.connect(f'file:{quote(dbfile)}?mode=ro', uri=True)
+            row = con.execute('SELECT meta FROM scans WHERE rowid=?', (state[2],)).fetchone()
+            meta = json.loads(row[0]) if row and row[0] else {}
+            for fn,op in con.execute('SELECT filename, op FROM files f JOIN scans s ' +
+                    'ON f.scan_id = s.rowid WHERE s.entry=? ORDER BY f.rowid', (entry,)):
+                if op: current.add(fn)
+                else: current.discard(fn)
+            con.close()
+        else: reset = True # rewritten, e.g. compacted
 
-    with open(entry, 'r', encoding='utf8') as fin:
-        inmeta = False
-        meta = {}
-        for l in fin.readlines():
+    con = sqlite3.connect(stagefile)
+    con.execute('PRAGMA journal_mode=OFF')
+    con.execute('PRAGMA synchronous=OFF')
+    con.executescript(SCHEMA)
+    rows, scans, nrows = [], 0, 0
+
+    def save_meta():
+        con.execute('INSERT OR REPLACE INTO scans (rowid, entry, date_gmt, folder, ' +
+                'checksum, meta) VALUES (?, ?, ?, ?, ?, ?)', (scan_id, entry,
+                    meta.get(':date_gmt:', ''), meta.get(':directory:', ''),
+                    meta.get(':checksum:', None), json.dumps(meta)))
+
+    def flush():
+        con.executemany('INSERT INTO files (scan_id, filename, op, modified_gmt, ' +
+                'size, checksum) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        rows.clear()
+
+    with open(entry, 'rb') as fin:
+        fin.seek(offset)
+        for l in fin:
+            if not l.endswith(b'\n'): break # still being written
+            offset += len(l)
             t = json.loads(l)
-            if t[0][0] == ':':
-                if not inmeta: meta = {}
-                inmeta = True
-                meta[t[0]] = t[1]
-            else:
-                if inmeta:
-                    inmeta = False
-                    print(meta)
-                    cur.execute('''INSERT INTO scans (entry, date_gmt, folder)
-                            VALUES (?, ?, ?)''',
-                            (entry, meta.get(':date_gmt:', ''), meta.get(':directory:', '')))
-                    scan_id = cur.lastrowid
-
-                fn = t[0]
-                op = 1 if fn in current else 2 # 1 modified 2 new
-                current[fn] = True
-                if fn =='.': pass # skip root creation from "legacy" scans and deletion later on
-                elif len(t)==1: # deletion
-                    del current[fn]
-                    cur.execute('''INSERT INTO files (scan_id, filename, op)
-                            VALUES(?, ?, ?)''', (scan_id, t[0], 0))
-                elif 'size' in t[1]: # new/modified file
-                    cur.execute('''INSERT INTO files (scan_id, filename, modified_gmt, size, sha1, op)
-                        VALUES(?, ?, ?, ?, ?, ?)''',
-                        (scan_id, t[0], t[1]['modified_gmt'], t[1]['size'], t[1]['sha1'], op))
-                else: # new/modified folder
-                    cur.execute('''INSERT INTO files (scan_id, filename, modified_gmt, op)
-                            VALUES(?, ?, ?, ?)''', (scan_id, t[0], t[1]['modified_gmt'], op))
-con.commit()
-con.close()
+            fn = t[0]
+            if fn[0] == ':':
+                if len(t) < 2: continue
+                if fn == ':scan:' or scan_id is None: # new scan starts
+                    if scan_id is not None: save_meta()
+                    scans += 1
+                    scan_id, meta = scans, {}
+                meta[fn] = t[1]
+                continue
+            if scan_id is None: # data before any metadata
+                scans += 1
+                scan_id = scans
+            if fn == '.': continue # skip root creation from "legacy" scans and deletion later on
+            if len(t) == 1: # deletion
+                current.discard(fn)
+                rows.append((scan_id, fn, 0, None, None, None))
+            else: # new/modified file, folder or link
+                r = t[1]
+                rows.append((scan_id, fn, 1 if fn in current else 2,
+                    r.get('modified_gmt', None), r.get('size', None),
+                    r.get(meta.get(':checksum:', None) or 'sha1', None)))
+                current.add(fn)
+            if len(rows) >= BATCH:
+                nrows += len(rows)
+                flush()
+    nrows += len(rows)
+    flush()
+    if scan_id is not None: save_meta()
+    con.commit()
+    con.close()
+    return entry, stagefile, offset, tail_hash(entry, offset), reset, scans, nrows
+
+def merge(con: sqlite3.Connection, res: tuple, state: tuple) -> None:
+    """Merge a staging database into target in one transaction."""
+    entry, stagefile, offset, tail, reset, scans, nrows = res
+    con.execute('ATTACH DATABASE ? AS stage', (stagefile,))
+    try:
+        with con: # transaction, rolled back on errors
+            if reset:
+                con.execute('DELETE FROM files WHERE scan_id IN ' +
+                        '(SELECT rowid FROM scans WHERE entry=?)', (entry,))
+                con.execute('DELETE FROM scans WHERE entry=?', (entry,))
+            last = state[2] if state and not reset else 0
+            base = con.execute('SELECT IFNULL(MAX(rowid), 0) FROM scans').fetchone()[0]
+            con.execute('UPDATE scans SET (date_gmt, folder, checksum, meta) = ' +
+                    '(SELECT date_gmt, folder, checksum, meta FROM stage.scans ' +
+                    'WHERE rowid=0) WHERE rowid=? AND EXISTS ' +
+                    '(SELECT 1 FROM stage.scans WHERE rowid=0)', (last,))
+            con.execute('INSERT INTO scans (rowid, entry, date_gmt, folder, checksum, ' +
+                    'meta) SELECT rowid + ?, entry, date_gmt, folder, checksum, meta ' +
+                    'FROM stage.scans WHERE rowid > 0 ORDER BY rowid', (base,))
+            con.execute('INSERT INTO files SELECT CASE scan_id WHEN 0 THEN ? ' +
+                    'ELSE scan_id + ? END, filename, op, modified_gmt, size, checksum ' +
+                    'FROM stage.files ORDER BY rowid', (last, base))
+            con.execute('INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?)',
+                    (entry, offset, tail, base + scans if scans else last))
+    finally: con.execute('DETACH DATABASE stage')
+
+def main():
+    parser = argparse.ArgumentParser(description='Import Fileson databases into SQLite')
+    parser.add_argument('sqlite', type=str, help='SQLite database to create or update')
+    parser.add_argument('fson', type=str, nargs='+', help='Fileson databases to import')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='Parallel worker processes (default number of CPUs)')
+    parser.add_argument('-s', '--synchronous', type=str.upper, default='NORMAL',
+        choices=['OFF', 'NORMAL', 'FULL'],
+        help='SQLite synchronous pragma, OFF is fastest but unsafe on power loss')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+        help='Print what is being done')
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.sqlite, isolation_level=None)
+    con.execute('PRAGMA journal_mode=WAL') # workers read while merging
+    con.execute(f'PRAGMA synchronous={args.synchronous}')
+    con.executescript(SCHEMA)
+    cols = [r[1] for r in con.execute('PRAGMA table_info(files)')]
+    if 'checksum' not in cols:
+        print(args.sqlite, 'was created by an older fson2sqlite, import into a new file.')
+        exit(1)
+    state = {e: (o, t, s) for e,o,t,s in con.execute('SELECT * FROM imports')}
+
+    tmpdir = tempfile.mkdtemp(prefix='fson2sqlite-',
+            dir=os.path.dirname(os.path.abspath(args.sqlite)))
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            futures = [pool.submit(stage, e, args.sqlite,
+                os.path.join(tmpdir, f'{i}.sqlite'), state.get(e, None))
+                for i,e in enumerate(dict.fromkeys(args.fson))]
+            for f in as_completed(futures):
+                res = f.result()
+                entry, stagefile, _, _, reset, scans, nrows = res
+                merge(con, res, state.get(entry, None))
+                os.remove(stagefile)
+                if args.verbose or reset:
+                    print(entry, 'reimported' if reset else 'imported',
+                            scans, 'new scans', nrows, 'rows')
+    finally:
+        for fn in os.listdir(tmpdir): os.remove(os.path.join(tmpdir, fn))
+        os.rmdir(tmpdir)
+    con.close()
+
+if __name__ == '__main__': main()
@@ -1,12 +1,13 @@
 import sys
 import hashlib
 
-def sha_file(filename, quick=False):
+def sha_file(filename, quick=False, limit=None):
     sha1 = hashlib.sha1()
     with open(filename, 'rb') as f:
         while True:
             data = f.read(65536)
             if not data: break
+            if limit: limit.consume(len(data)) # throttle.TokenBucket
             sha1.update(data)
             if quick: break
     return sha1.hexdigest()
@@ -0,0 +1,133 @@
+"""Minimal Linux inotify binding with ctypes and a recursive tree watcher."""
+import ctypes, ctypes.util, errno, os, select, struct
+
+IN_ACCESS, IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x1, 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+IN_Q_OVERFLOW, IN_IGNORED = 0x4000, 0x8000
+IN_ONLYDIR, IN_DONT_FOLLOW, IN_ISDIR = 0x01000000, 0x02000000, 0x40000000
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+
+# Everything that changes Fileson records (content, metadata or existence)
+CHANGES = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT = struct.Struct('iIII') # wd, mask, cookie, len (of name)
+
+_libc = None
+def _lib():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return _libc
+
+def _check(res: int) -> int:
+    if res < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return res
+
+class Inotify(object):
+    """An inotify instance, see inotify(7) for masks and semantics."""
+    def __init__(self) -> None:
+        self.fd = _check(_lib().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def add_watch(self, path: str, mask: int=CHANGES) -> int:
+        """Watch path (directory or file), return watch descriptor."""
+        return _check(_lib().inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd: int) -> None:
+        try: _check(_lib().inotify_rm_watch(self.fd, wd))
+        except OSError as e:
+            if e.errno != errno.EINVAL: raise # already gone
+
+    def read(self, timeout: float=None) -> list:
+        """Return list of (wd, mask, cookie, name) events, waiting up to timeout."""
+        if not select.select([self.fd], [], [], timeout)[0]: return []
+        try: buf = os.read(self.fd, 2**16)
+        except BlockingIOError: return []
+        events, i = [], 0
+        while i < len(buf):
+            wd, mask, cookie, n = _EVENT.unpack_from(buf, i)
+            name = buf[i+_EVENT.size:i+_EVENT.size+n].rstrip(b'\0')
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+            i += _EVENT.size + n
+        return events
+
+    def close(self) -> None: os.close(self.fd)
+
+class TreeWatcher(object):
+    """Watch a directory tree and collect changed paths relative to it.
+
+    Changes are coalesced into :attr:`paths` (entries to re-stat) and
+    :attr:`subtrees` (directories to rescan fully, e.g. new or moved
+    ones, and '.' when the kernel event queue overflowed).
+
+    Args:
+        directory (str): Root of the tree
+        skip (callable): skip(DirEntry) returns True for entries not watched
+    """
+    def __init__(self, directory: str, skip=lambda e: False) -> None:
+        self.directory, self.skip = directory, skip
+        self.inotify = Inotify()
+        self.wds = {} # wd: relative path of watched dir
+        self.paths, self.subtrees = set(), set()
+        self.add_tree('.')
+
+    def _join(self, d: str, name: str) -> str:
+        return name if d == '.' else os.path.join(d, name)
+
+    def add_tree(self, rel: str) -> None:
+        """Watch rel and directories under it (skipping those skip says)."""
+        todo = [rel]
+        while todo:
+            d = todo.pop()
+            try:
+                wd = self.inotify.add_watch(os.path.join(self.directory, d),
+                        CHANGES | IN_ONLYDIR | IN_DONT_FOLLOW)
+                self.wds[wd] = d
+                for e in os.scandir(os.path.join(self.directory, d)):
+                    if e.is_dir(follow_symlinks=False) and not self.skip(e):
+                        todo.append(self._join(d, e.name))
+            except (FileNotFoundError, NotADirectoryError): pass # gone already
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise OSError(e.errno, 'Out of inotify watches, increase ' +
+                            'fs.inotify.max_user_watches') from e
+                raise
+
+    def remove_tree(self, rel: str) -> None:
+        """Stop watching rel and directories under it."""
+        prefix = rel + os.sep
+        for wd,d in list(self.wds.items()):
+            if d == rel or d.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.wds[wd]
+
+    def read(self, timeout: float=None) -> int:
+        """Wait up to timeout for events and collect them, return count."""
+        events = self.inotify.read(timeout)
+        for wd,mask,cookie,name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.subtrees.add('.') # lost events, rescan everything
+                continue
+            d = self.wds.get(wd, None)
+            if mask & IN_IGNORED: self.wds.pop(wd, None)
+            if d is None or not name: continue # events of the dir itself
+            p = self._join(d, name)
+            if d != '.': self.paths.add(d) # parent mtime changes
+            if mask & IN_ISDIR:
+                self.subtrees.add(p)
+                if mask & IN_MOVED_FROM: self.remove_tree(p)
+                if mask & (IN_CREATE | IN_MOVED_TO): self.add_tree(p)
+            else: self.paths.add(p)
+        return len(events)
+
+    def take(self) -> tuple:
+        """Return and reset collected (paths, subtrees)."""
+        res = (self.paths, self.subtrees)
+        self.paths, self.subtrees = set(), set()
+        return res
+
+    def close(self) -> None: self.inotify.close()
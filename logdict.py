@@ -10,6 +10,7 @@ class LogDict(MutableMapping):
     All set and delete operations are written to append-only log and saved
     either real-time or upon request in line-based JSON format. Special
     version key and :meth:`slice` can be used to implement versioning.
+    Values that are mappings but not dicts are serialized as dicts.
 
     See :class:`collections.abc.MutableMapping` for interface details.
 
@@ -73,7 +74,7 @@ class LogDict(MutableMapping):
         """
         with open(filename, 'w', encoding='utf8') as fout:
             for t in self.log:
-                json.dump(t, fout)
+                json.dump(t, fout, default=dict)
                 fout.write('\n')
 
     def __del__(self):
@@ -82,14 +83,14 @@ class LogDict(MutableMapping):
     def __setitem__(self, key, value):
         self.log.append((key, value)) # tuple for set
         if self.__logfile:
-            json.dump((key, value), self.__logfile)
+            json.dump((key, value), self.__logfile, default=dict)
             self.__logfile.write('\n')
         self.__d[key] = value
 
     def __delitem__(self, key):
         self.log.append((key,)) # single item tuple for del
         if self.__logfile:
-            json.dump((key,), self.__logfile)
+            json.dump((key,), self.__logfile, default=dict)
             self.__logfile.write('\n')
         del self.__d[key]
 
@@ -0,0 +1,182 @@
+"""Counters, histograms and profiling to instrument scan, backup and restore.
+
+Metrics are registered in a process-wide :data:`registry` and can be
+written periodically to a JSON lines file and/or served in Prometheus
+text format over HTTP:
+
+    >>> files = counter('scan_files', 'Files scanned')
+    >>> files.inc()
+    >>> with timer('scan_stat_seconds', 'Latency of stat calls'): pass
+    >>> start('metrics.jsonl', port=9100) # write every 10 s, serve on 9100
+    >>> stop() # final snapshot
+"""
+import json, threading, time
+
+# Default histogram buckets, suitable for latencies in seconds
+BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1, 10, 60)
+
+class Counter(object):
+    """Monotonic counter."""
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str='') -> None:
+        self.name, self.help = name, help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n: float=1) -> None:
+        with self._lock: self.value += n
+
+    def snapshot(self) -> float: return self.value
+
+    def prometheus(self) -> list:
+        return [f'{self.name} {self.value}']
+
+class Histogram(object):
+    """Histogram with cumulative buckets, sum and count."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str='', buckets: tuple=BUCKETS) -> None:
+        self.name, self.help = name, help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum, self.count = 0.0, 0
+        self._lock = threading.Lock()
+
+    def observe(self, v: float) -> None:
+        with self._lock:
+            self.sum += v
+            self.count += 1
+            for i,b in enumerate(self.buckets):
+                if v <= b: self.counts[i] += 1
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip(map(str, self.buckets), self.counts))}
+
+    def prometheus(self) -> list:
+        lines = [f'{self.name}_bucket{{le="{b}"}} {c}'
+                for b,c in zip(self.buckets, self.counts)]
+        return lines + [f'{self.name}_bucket{{le="+Inf"}} {self.count}',
+                f'{self.name}_sum {self.sum}', f'{self.name}_count {self.count}']
+
+class _Timer(object):
+    """Context manager observing elapsed seconds to a histogram."""
+    def __init__(self, hist: Histogram) -> None: self.hist = hist
+
+    def __enter__(self) -> '_Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.elapsed = time.perf_counter() - self.start
+        self.hist.observe(self.elapsed)
+
+class Registry(object):
+    """Collection of named metrics with JSON lines and Prometheus output."""
+    def __init__(self, prefix: str='fileson_') -> None:
+        self.prefix = prefix
+        self.metrics = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread, self._server, self._filename = None, None, None
+
+    def _get(self, cls, name: str, *args):
+        with self._lock:
+            if not name in self.metrics:
+                self.metrics[name] = cls(self.prefix + name, *args)
+            return self.metrics[name]
+
+    def counter(self, name: str, help: str='') -> Counter:
+        """Get or create a counter."""
+        return self._get(Counter, name, help)
+
+    def histogram(self, name: str, help: str='', buckets: tuple=BUCKETS) -> Histogram:
+        """Get or create a histogram."""
+        return self._get(Histogram, name, help, buckets)
+
+    def timer(self, name: str, help: str='') -> _Timer:
+        """Return context manager timing its body into a histogram."""
+        return _Timer(self.histogram(name, help))
+
+    def snapshot(self) -> dict:
+        """Return dict with timestamp, elapsed seconds and all metrics."""
+        now = time.time()
+        return {'time': now, 'elapsed': now - self.started,
+                'metrics': {k: m.snapshot() for k,m in self.metrics.items()}}
+
+    def prometheus(self) -> str:
+        """Return all metrics in Prometheus text exposition format."""
+        lines = []
+        for m in list(self.metrics.values()):
+            lines += [f'# HELP {m.name} {m.help}', f'# TYPE {m.name} {m.kind}']
+            lines += m.prometheus()
+        return '\n'.join(lines) + '\n'
+
+    def write(self) -> None:
+        """Append a snapshot to the metrics file, if one is set."""
+        if not self._filename: return
+        with open(self._filename, 'a', encoding='utf8') as fout:
+            json.dump(self.snapshot(), fout)
+            fout.write('\n')
+
+    def start(self, filename: str=None, port: int=None, interval: float=10) -> None:
+        """Start periodic JSON lines writing and/or HTTP endpoint."""
+        self._filename = filename
+        if port:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # slow import
+            registry = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.prometheus().encode('utf8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, *args): pass # keep stdout clean
+            self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        if filename:
+            def loop():
+                while not self._stop.wait(interval): self.write()
+            self._thread = threading.Thread(target=loop, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop background activity and write a final snapshot."""
+        self._stop.set()
+        if self._thread: self._thread.join()
+        if self._server: self._server.shutdown()
+        self.write()
+
+# Process-wide registry and shortcuts to it
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+timer = registry.timer
+start = registry.start
+stop = registry.stop
+
+def profile(func, args, filename: str, top: int=25) -> object:
+    """Run func(args) under cProfile, dump stats to filename.
+
+    The top functions by cumulative time are printed to stderr, and the
+    dump can be further examined with :mod:`pstats` or e.g. snakeviz.
+    """
+    import cProfile, pstats, sys
+    prof = cProfile.Profile()
+    try: return prof.runcall(func, args)
+    finally:
+        prof.dump_stats(filename)
+        pstats.Stats(prof, stream=sys.stderr).sort_stats('cumulative').print_stats(top)
+
+def add_arguments(parser) -> None:
+    """Add --metrics, --metrics-port and --profile to an argument parser."""
+    parser.add_argument('--metrics', type=str, default=None,
+        help='Append metrics as JSON lines to this file every 10 seconds')
+    parser.add_argument('--metrics-port', type=int, default=None,
+        help='Serve metrics in Prometheus text format on localhost port')
+    parser.add_argument('--profile', type=str, default=None,
+        help='Run command under cProfile and dump pstats to this file')
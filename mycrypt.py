@@ -1,8 +1,12 @@
 """On-the-fly AES256 CTR encryption with file-like interface."""
-from Crypto.Cipher import AES
-from Crypto.Util import Counter
 import hashlib, os
 
+def _aes() -> tuple:
+    """Return (AES, Counter) from pycryptodome, imported on first use."""
+    from Crypto.Cipher import AES
+    from Crypto.Util import Counter
+    return AES, Counter
+
 def sha1(s: object) -> bytes:
     """One-off sha1 hashing of bytes or a string (encoded as utf8)."""
     m = hashlib.sha1()
@@ -22,6 +26,19 @@ def calc_etag(infile, partsize=8):
     return hashlib.md5(b''.join(md5_digests)).hexdigest() + '-' + \
         str(len(md5_digests))
 
+def ctr_decrypt(data: bytes, key: bytes, iv: bytes, offset: int) -> bytes:
+    """Decrypt data that starts at given offset of the encrypted payload.
+
+    CTR mode allows random access, so a range of an :class:`AESFile`
+    encrypted object (excluding the 16 byte iv prefix) can be checked
+    without reading all of it.
+    """
+    block, skip = divmod(offset, 16)
+    AES, Counter = _aes()
+    obj = AES.new(key, AES.MODE_CTR, counter=Counter.new(128, initial_value=
+        (int.from_bytes(iv, byteorder='big') + block) % 2**128))
+    return obj.decrypt(bytes(skip) + data)[skip:]
+
 class AESFile:
     """On-the-fly AES encryption (on read) and decryption (on write).
 
@@ -34,7 +51,8 @@ class AESFile:
 
     Args:
         filename (str): File to open for reading (encrypt on the fly)
-            or writing (decrypt on the fly)
+            or writing (decrypt on the fly), or a binary file object
+            (closed along with this one)
         mode (str): Either 'rb' or 'wb', just like with :func:`io.open`
         key (bytes): Encryption/decryption key (32 bytes for AES256)
         iv (bytes): Initial value (16 bytes), if not set uses os.urandom
@@ -43,6 +61,7 @@ class AESFile:
         AESFile: File-like object
     """
     def __initAES(self) -> None:
+        AES, Counter = _aes()
         self.obj = AES.new(self.key, AES.MODE_CTR, counter=Counter.new(
             128, initial_value=int.from_bytes(self.iv, byteorder='big')))
         #print('Initialized AES with IV', self.iv.hex())
@@ -55,7 +74,8 @@ class AESFile:
         self._pos = 0
         self.key = key
         self.mode = mode
-        self.fp = open(filename, mode)
+        self.fp = open(filename, mode) if isinstance(filename, (str, bytes,
+            os.PathLike)) else filename
 
         if mode == 'rb':
             self.iv = iv or os.urandom(16)
@@ -125,6 +145,10 @@ class AESFile:
         elif whence==2: # relative to file end, offset=0
             self._pos = 16 + self.fp.tell()
 
+    def seekable(self) -> bool:
+        """Only reading (encrypting) supports :meth:`seek`."""
+        return self.mode == 'rb'
+
     def close(self) -> None:
         """Close the file stream."""
         self.fp.close()
@@ -0,0 +1,121 @@
+"""Hierarchical path index with per-subtree file, dir and byte counts."""
+import os
+from typing import Generator, Tuple
+
+class _Node(object):
+    """Directory node, files are kept as name: size in the parent node."""
+    __slots__ = ('children', 'files', 'entry', 'nfiles', 'ndirs', 'nbytes')
+
+    def __init__(self) -> None:
+        self.children, self.files = {}, {}
+        self.entry = False # True if the dir itself is in the index
+        self.nfiles, self.ndirs, self.nbytes = 0, 0, 0
+
+class PathIndex(object):
+    """Trie of path components maintained incrementally on add and remove.
+
+    Every directory node keeps file, dir and byte totals of its subtree,
+    so subtree statistics are O(depth) and listing paths under a prefix
+    takes time proportional to the answer. Paths are relative with '.'
+    meaning the root itself, like Fileson keys.
+
+    Args:
+        sep (str): Path separator, defaults to os.sep
+    """
+    def __init__(self, sep: str=os.sep) -> None:
+        self.sep = sep
+        self.root = _Node()
+
+    def _split(self, path: str) -> list:
+        path = path.strip(self.sep)
+        return [] if path in ('.', '') else path.split(self.sep)
+
+    def _walk(self, parts: list, create: bool=False) -> list:
+        """Return list of nodes from root along parts (None if missing)."""
+        nodes = [self.root]
+        for part in parts:
+            node = nodes[-1].children.get(part)
+            if node is None:
+                if not create: return None
+                node = nodes[-1].children[part] = _Node()
+            nodes.append(node)
+        return nodes
+
+    def add(self, path: str, size: int=None) -> None:
+        """Add a file (size is int) or a directory (size is None)."""
+        parts = self._split(path)
+        if size is None: # dir
+            nodes = self._walk(parts, create=True)
+            if nodes[-1].entry: return
+            nodes[-1].entry = True
+            for n in nodes: n.ndirs += 1
+        elif not parts: raise ValueError('Root cannot be a file')
+        else:
+            nodes = self._walk(parts[:-1], create=True)
+            old = nodes[-1].files.get(parts[-1])
+            nodes[-1].files[parts[-1]] = size
+            for n in nodes:
+                if old is None: n.nfiles += 1
+                n.nbytes += size - (old or 0)
+
+    def remove(self, path: str, file: bool=None) -> None:
+        """Remove a file or directory entry (subtree contents stay).
+
+        Use file=True or False to remove only a file or dir by that name,
+        otherwise a file is preferred.
+        """
+        parts = self._split(path)
+        nodes = self._walk(parts[:-1]) if parts else [self.root]
+        if nodes is None: return
+        if parts and parts[-1] in nodes[-1].files and file is not False:
+            size = nodes[-1].files.pop(parts[-1])
+            for n in nodes:
+                n.nfiles -= 1
+                n.nbytes -= size
+        elif not file:
+            node = nodes[-1].children.get(parts[-1]) if parts else self.root
+            if node is None or not node.entry: return
+            node.entry = False
+            if parts: nodes.append(node)
+            for n in nodes: n.ndirs -= 1
+        # Prune nodes that no longer hold anything
+        for i in range(len(nodes)-1, 0, -1):
+            n = nodes[i]
+            if n.entry or n.files or n.children: break
+            del nodes[i-1].children[parts[i-1]]
+
+    def stats(self, prefix: str='.') -> Tuple[int, int, int]:
+        """Return (files, dirs, bytes) under prefix, including itself."""
+        nodes = self._walk(self._split(prefix))
+        if nodes is None: return (0, 0, 0)
+        n = nodes[-1]
+        return (n.nfiles, n.ndirs, n.nbytes)
+
+    def _iter(self, node: _Node, path: str, files: bool, dirs: bool,
+            maxdepth: int, depth: int=0) -> Generator[str, None, None]:
+        if dirs and node.entry: yield path
+        join = (lambda n: n) if path == '.' else (lambda n: path + self.sep + n)
+        if files:
+            for name in node.files: yield join(name)
+        if maxdepth is not None and depth >= maxdepth: return
+        for name,child in node.children.items():
+            yield from self._iter(child, join(name), files, dirs, maxdepth, depth+1)
+
+    def files(self, prefix: str='.') -> Generator[str, None, None]:
+        """Yield paths of files under prefix."""
+        nodes = self._walk(self._split(prefix))
+        if nodes: yield from self._iter(nodes[-1], prefix, True, False, None)
+
+    def dirs(self, prefix: str='.', maxdepth: int=None) -> Generator[str, None, None]:
+        """Yield paths of dirs under prefix (and prefix itself if a dir)."""
+        nodes = self._walk(self._split(prefix))
+        if nodes: yield from self._iter(nodes[-1], prefix, False, True, maxdepth)
+
+    def depth(self) -> int:
+        """Return maximum separator count of dir paths, like p.count(sep)."""
+        def walk(node, d):
+            deepest = d if node.entry else -1
+            for child in node.children.values():
+                deepest = max(deepest, walk(child, d+1))
+            return deepest
+        return max(walk(self.root, -1), 0)
@@ -0,0 +1,270 @@
+"""Small query language over Fileson databases.
+
+Expressions compare fields of entries and combine them with and, or, not
+and parentheses, for example::
+
+    size > 1G and mtime >= 2023 and path ~ 'Photos/**'
+    type = file and not backup
+    name ~ '*.tmp' or (scan >= 10 and checksum = 'e5fa44f2b31c1f...')
+
+Fields are path, name, type (file, dir or link), size, mtime (modified
+GMT as 'YYYY-MM-DD HH:MM:SS', compared as text so prefixes like 2023-06
+work, and = matches a prefix), checksum (of any type), scan (version in
+which the entry last changed) and backup (file checksum found in a
+backup log). Operators are = != < <= > >= and ~ for gitignore-style
+glob match (see :mod:`skip`). Sizes accept k, M and G suffixes. Missing
+values (size of a directory, for example) never compare true.
+
+Entries are read in a single streaming pass over the log keeping only
+those currently matching, and lines under paths a top-level glob rules
+out are not even decoded. For a SQLite database made by fson2sqlite.py,
+the expression is translated to SQL where possible.
+"""
+import json, operator, os, re, sqlite3
+from skip import glob_regex
+from urllib.parse import quote
+
+CHECKSUMS = ('sha1', 'sha1fast') # record keys holding a checksum
+
+FIELDS = ('path', 'name', 'type', 'size', 'mtime', 'checksum', 'scan', 'backup')
+
+OPS = {'=': operator.eq, '==': operator.eq, '!=': operator.ne, '<': operator.lt,
+        '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+TOKEN = re.compile(r'''\s*(?:(?P<op><=|>=|!=|==|=|<|>|~|\(|\))|''' +
+        r'''(?P<str>'[^']*'|"[^"]*")|(?P<word>[^\s()<>=!~'"]+))''')
+
+class QueryError(ValueError):
+    """Raised for invalid query expressions."""
+
+def parse_size(s: str) -> int:
+    """Parse size like 100, 10k or 1G (decimal multiples) to int."""
+    return int(s.replace('G', '000M').replace('M', '000k').replace('k', '000'))
+
+def checksum_of(r: dict) -> str:
+    """Return the checksum in a record, whatever its type, or None."""
+    for k in CHECKSUMS:
+        if k in r: return r[k]
+    return None
+
+def type_of(r: dict) -> str:
+    if 'link' in r: return 'link'
+    return 'dir' if r.get('size', None) is None else 'file'
+
+def fields(p: str, r: dict, scan: int, backups: set=None) -> dict:
+    """Return all query fields of an entry as a dict."""
+    return {'path': p, 'name': os.path.basename(p), 'type': type_of(r),
+            'size': r.get('size', None), 'mtime': r.get('modified_gmt', None),
+            'checksum': checksum_of(r), 'scan': scan,
+            'backup': None if backups is None else r.get('sha1', None) in backups}
+
+def _tokens(expr: str) -> list:
+    pos, out = 0, []
+    expr = expr.rstrip()
+    while pos < len(expr):
+        m = TOKEN.match(expr, pos)
+        if not m or m.end() == pos: raise QueryError(f'Cannot parse at: {expr[pos:]}')
+        kind = m.lastgroup
+        val = m.group(kind)
+        out.append((kind, val[1:-1] if kind == 'str' else val))
+        pos = m.end()
+    return out
+
+class Query(object):
+    """Parsed query expression.
+
+    Args:
+        expr (str): Expression, see module documentation
+        backups (set): SHA1 checksums backed up, needed for backup field
+    """
+    def __init__(self, expr: str, backups: set=None) -> None:
+        self.expr, self.backups = expr, backups
+        self._toks = _tokens(expr)
+        self._pos = 0
+        self.tree = self._or() if self._toks else ('true',)
+        if self._pos < len(self._toks):
+            raise QueryError(f'Unexpected {self._toks[self._pos][1]!r}')
+        self.match = self._compile(self.tree)
+        self.prefix = self._prefix(self.tree)
+
+    # Recursive descent parser producing a tuple tree
+    def _peek(self): return self._toks[self._pos] if self._pos < len(self._toks) else (None, None)
+
+    def _next(self):
+        t = self._peek()
+        if t[0] is None: raise QueryError('Unexpected end of expression')
+        self._pos += 1
+        return t
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == ('word', 'or'): self._next(); node = ('or', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peek() == ('word', 'and'): self._next(); node = ('and', node, self._not())
+        return node
+
+    def _not(self):
+        kind, val = self._next()
+        if (kind, val) == ('word', 'not'): return ('not', self._not())
+        if (kind, val) == ('op', '('):
+            node = self._or()
+            if self._next() != ('op', ')'): raise QueryError('Missing )')
+            return node
+        if kind != 'word' or val not in FIELDS: raise QueryError(f'Unknown field {val!r}')
+        field = val
+        if field == 'backup' and self._peek()[1] not in OPS and self._peek()[1] != '~':
+            return ('cmp', 'backup', '=', True) # bare boolean
+        kind, op = self._next()
+        if kind != 'op' or (op not in OPS and op != '~'): raise QueryError(f'Expected operator, got {op!r}')
+        return ('cmp', field, op, self._value(field, op, self._next()[1]))
+
+    def _value(self, field, op, val):
+        if op == '~':
+            if field not in ('path', 'name'): raise QueryError('~ only works for path and name')
+            return val
+        try:
+            if field == 'size': return parse_size(val)
+            if field == 'scan': return int(val)
+        except ValueError: raise QueryError(f'Bad {field} value {val!r}') from None
+        if field == 'backup':
+            if val not in ('true', 'false'): raise QueryError('backup is true or false')
+            return val == 'true'
+        if field == 'type' and val not in ('file', 'dir', 'link'):
+            raise QueryError('type is file, dir or link')
+        return val
+
+    def _compile(self, node):
+        """Turn tree into a function of (path, record, scan)."""
+        if node[0] == 'true': return lambda p,r,s: True
+        if node[0] in ('and', 'or'):
+            a, b = self._compile(node[1]), self._compile(node[2])
+            if node[0] == 'and': return lambda p,r,s: a(p,r,s) and b(p,r,s)
+            return lambda p,r,s: a(p,r,s) or b(p,r,s)
+        if node[0] == 'not':
+            a = self._compile(node[1])
+            return lambda p,r,s: not a(p,r,s)
+        _, field, op, val = node
+        get = {'path': lambda p,r,s: p,
+                'name': lambda p,r,s: os.path.basename(p),
+                'type': lambda p,r,s: type_of(r),
+                'size': lambda p,r,s: r.get('size', None),
+                'mtime': lambda p,r,s: r.get('modified_gmt', None),
+                'checksum': lambda p,r,s: checksum_of(r),
+                'scan': lambda p,r,s: s,
+                'backup': self._backup}[field]
+        if field == 'backup' and self.backups is None:
+            raise QueryError('backup field needs a backup log')
+        if op == '~':
+            rx = re.compile(glob_regex(val)).fullmatch
+            return lambda p,r,s: rx(get(p,r,s)) is not None
+        if field == 'mtime' and op in ('=', '=='):
+            return lambda p,r,s: (get(p,r,s) or '\0').startswith(val)
+        cmp = OPS[op]
+        def match(p, r, s):
+            v = get(p, r, s)
+            return v is not None and cmp(v, val)
+        return match
+
+    def _backup(self, p, r, s):
+        return 'sha1' in r and r['sha1'] in self.backups
+
+    def _prefix(self, node) -> str:
+        """Return directory all matches must be under (from anchored path
+        globs ANDed at top level), or None."""
+        if node[0] == 'and':
+            return self._prefix(node[1]) or self._prefix(node[2])
+        if node[0] != 'cmp' or node[1] != 'path' or node[2] != '~': return None
+        glob = node[3].strip('/')
+        if '/' not in glob and os.sep not in glob: return None # any depth
+        m = re.match(r'[^*?\[]*', glob).group()
+        parts = re.split('[/' + re.escape(os.sep) + ']', m)[:-1] # full components only
+        return os.sep.join(parts) if parts else None
+
+    def sql(self, node=None) -> tuple:
+        """Return (SQL condition, params) filtering at least all matches.
+
+        Parts not expressible in SQL are left out, so results still need
+        to be checked with :meth:`match`.
+        """
+        res = self._sql(self.tree if node is None else node)
+        return res or ('1', [])
+
+    _COLUMNS = {'path': 'filename', 'name': 'basename(filename)', 'size': 'size',
+            'mtime': 'modified_gmt', 'checksum': 'checksum', 'scan': 'scan',
+            'type': "CASE WHEN size IS NULL THEN 'dir' ELSE 'file' END"}
+
+    def _sql(self, node):
+        if node[0] == 'true': return None
+        if node[0] in ('and', 'or'):
+            a, b = self._sql(node[1]), self._sql(node[2])
+            if node[0] == 'and':
+                if not (a and b): return a or b # weaker filter is fine
+                return f'({a[0]} AND {b[0]})', a[1] + b[1]
+            if not (a and b): return None
+            return f'({a[0]} OR {b[0]})', a[1] + b[1]
+        if node[0] == 'not': return None # NULLs make negation inexact
+        _, field, op, val = node
+        if field == 'backup' or (field == 'type' and val == 'link'): return None
+        col = self._COLUMNS[field]
+        if op == '~': return f'{col} REGEXP ?', [glob_regex(val)]
+        if field == 'mtime' and op in ('=', '=='): return f'{col} GLOB ?', [val + '*']
+        return f'{col} {"=" if op == "==" else op} ?', [val]
+
+def stream(filename: str, q: Query, back: int=0):
+    """Yield (path, record, scan) of entries in a Fileson DB matching q.
+
+    Args:
+        filename (str): Fileson database
+        q (Query): Query to evaluate
+        back (int): Number of scans to go back in history, like db.fson~N
+    """
+    end = None
+    if back:
+        with open(filename, 'r', encoding='utf8') as fin:
+            last = max((json.loads(l)[1] for l in fin if l.startswith('[":scan:",')), default=0)
+        end = [':scan:', last - back + 1]
+    if q.prefix: # skip decoding lines that cannot match, and their deletions
+        quoted = json.dumps(q.prefix)[:-1]
+        heads = ('[' + quoted + '"', '[' + json.dumps(q.prefix + os.sep)[:-1])
+    found, scan = {}, 0
+    with open(filename, 'r', encoding='utf8') as fin:
+        for l in fin:
+            if l.startswith('[":'): # metadata
+                t = json.loads(l)
+                if t == end: break
+                if t[0] == ':scan:' and len(t) == 2: scan = t[1]
+                continue
+            if q.prefix and not l.startswith(heads): continue
+            t = json.loads(l)
+            if len(t) == 2 and q.match(t[0], t[1], scan): found[t[0]] = (t[1], scan)
+            else: found.pop(t[0], None)
+    for p,(r,s) in found.items(): yield p, r, s
+
+LATEST = '''WITH latest AS (SELECT s.entry, f.filename, f.op, f.modified_gmt,
+    f.size, f.checksum, s.checksum AS ctype,
+    json_extract(s.meta, '$.":scan:"') AS scan,
+    ROW_NUMBER() OVER (PARTITION BY s.entry, f.filename ORDER BY f.rowid DESC) AS n
+    FROM files f JOIN scans s ON f.scan_id = s.rowid)
+SELECT entry, filename, modified_gmt, size, checksum, ctype, scan FROM latest
+WHERE n = 1 AND op != 0 AND '''
+
+def query_sqlite(filename: str, q: Query):
+    """Yield (entry, path, record, scan) of matches in a fson2sqlite DB.
+
+    The current state of each imported .fson file is queried. Links are
+    not distinguished from directories there.
+    """
+    con = sqlite3.connect(f'file:{quote(filename)}?mode=ro', uri=True)
+    con.create_function('basename', 1, lambda p: os.path.basename(p), deterministic=True)
+    con.create_function('regexp', 2, lambda rx,v: v is not None and
+            re.fullmatch(rx, v) is not None, deterministic=True)
+    cond, params = q.sql()
+    for entry,p,mtime,size,csum,ctype,scan in con.execute(LATEST + cond, params):
+        r = {'modified_gmt': mtime}
+        if size is not None: r['size'] = size
+        if csum is not None: r[ctype or 'sha1'] = csum
+        if q.match(p, r, scan): yield entry, p, r, scan
+    con.close()
@@ -0,0 +1,142 @@
+"""Compiled matcher for scan skip patterns.
+
+Patterns are plain path fragments matched anywhere in the full path, like
+before, or gitignore-style globs prefixed with 'glob:':
+
+    glob:*.tmp          any file or dir named *.tmp, at any level
+    glob:build/         only directories named build
+    glob:/cache         cache directly under the scanned directory
+    glob:src/**/gen     '/' anchors to scanned directory, ** spans dirs
+    glob:!keep.tmp      re-include something an earlier pattern skipped
+
+Fragments are compiled into a single regular expression shaped like a
+trie of them (so it is one search per path, not one per pattern), globs
+into another one with a named group per pattern, matched against the
+whole path. Skipped directories are not descended into.
+"""
+import os, re, threading
+
+GLOB = 'glob:'
+
+def literal_regex(words: list) -> str:
+    """Return regex matching any of the words, factored as a trie."""
+    trie = {}
+    for w in words:
+        node = trie
+        for c in w: node = node.setdefault(c, {})
+        node[''] = {} # a word ends here
+    def build(node):
+        alts = [re.escape(c) + build(n) for c,n in sorted(node.items()) if c]
+        if not alts: return ''
+        if '' in node: return '(?:' + '|'.join(alts) + ')?'
+        return alts[0] if len(alts) == 1 else '(?:' + '|'.join(alts) + ')'
+    return build(trie)
+
+def glob_regex(glob: str, sep: str=os.sep) -> str:
+    """Translate gitignore-style glob to regex for a path relative to root.
+
+    Globs without a separator (other than a trailing one) match the name
+    at any depth, others are anchored to the root.
+    """
+    anchored = sep in glob.rstrip(sep) or '/' in glob.rstrip('/')
+    glob = glob.strip('/').strip(sep)
+    s, notsep = re.escape(sep), '[^' + re.escape(sep) + ']'
+    out, i = [], 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith('**', i):
+            i += 2
+            if i < len(glob) and glob[i] in '/' + sep:
+                out.append(f'(?:.*{s})?') # zero or more dirs
+                i += 1
+            else: out.append('.*')
+            continue
+        if c == '*': out.append(notsep + '*')
+        elif c == '?': out.append(notsep)
+        elif c in '/' + sep: out.append(s)
+        elif c == '[' and ']' in glob[i+2:]:
+            j = glob.index(']', i+2)
+            body = glob[i+1:j]
+            if body[0] == '!': body = '^' + body[1:]
+            out.append('[' + body.replace('\\', '\\\\') + ']')
+            i = j
+        else: out.append(re.escape(c))
+        i += 1
+    return ('' if anchored else f'(?:.*{s})?') + ''.join(out)
+
+class SkipMatcher(object):
+    """Decide which entries to skip in a scan and keep tally of them.
+
+    Call with a DirEntry (or anything with path, is_dir() and stat()).
+    Skipped entries and bytes of skipped files are counted per pattern
+    in :attr:`skipped` as {pattern: [entries, bytes]}.
+
+    Args:
+        patterns (list): Path fragments and 'glob:' rules, see module doc
+        root (str): Scanned directory, globs are relative to it
+    """
+    def __init__(self, patterns: list, root: str) -> None:
+        self.patterns = [p for p in patterns if p] # empty would skip all
+        self.skipped = {p: [0, 0] for p in self.patterns}
+        self._lock = threading.Lock()
+        prefix = re.escape(root.rstrip(os.sep) + os.sep)
+
+        # Path fragments, first pattern for each
+        self._literals = {}
+        for i,p in enumerate(self.patterns):
+            if not p.startswith(GLOB): self._literals.setdefault(p, i)
+        self._lit = re.compile(literal_regex(self._literals)) \
+                if self._literals else None
+
+        # (group, regex, dironly, negate) for each glob
+        self._globs = []
+        for i,p in enumerate(self.patterns):
+            if not p.startswith(GLOB): continue
+            glob = p[len(GLOB):]
+            negate = glob.startswith('!')
+            if negate: glob = glob[1:]
+            dironly = glob.endswith('/') or glob.endswith(os.sep)
+            self._globs.append((f'p{i}', prefix + glob_regex(glob), dironly, negate))
+
+        def combine(globs):
+            if not globs: return None
+            return re.compile('|'.join(f'(?P<{g}>{rx})' for g,rx,_,_ in globs))
+        self._any = combine([g for g in self._globs if not g[2]])
+        self._dir = combine(self._globs)
+        self._negations = any(g[3] for g in self._globs)
+        self._compiled = {int(g[1:]): (re.compile(rx), d, n) for g,rx,d,n in self._globs}
+
+    def match(self, path: str, isdir: bool=False) -> str:
+        """Return the pattern deciding to skip path, or None to keep it."""
+        found = []
+        m = self._lit and self._lit.search(path)
+        if m: found.append(self._literals[m.group()])
+        rx = self._dir if isdir else self._any
+        m = rx and rx.fullmatch(path)
+        if m: found.append(int(m.lastgroup[1:]))
+        if not found: return None
+        if not self._negations: return self.patterns[min(found)]
+
+        decision = None # last matching rule wins, like in gitignore
+        for i,p in enumerate(self.patterns):
+            if i not in self._compiled:
+                if p in path: decision = i
+                continue
+            rx, dironly, negate = self._compiled[i]
+            if (isdir or not dironly) and rx.fullmatch(path):
+                decision = None if negate else i
+        return None if decision is None else self.patterns[decision]
+
+    def __call__(self, e) -> bool:
+        """Return True if DirEntry e should be skipped, and count it."""
+        isdir = e.is_dir(follow_symlinks=False)
+        pattern = self.match(e.path, isdir)
+        if pattern is None: return False
+        size = 0 if isdir else e.stat(follow_symlinks=False).st_size
+        with self._lock:
+            c = self.skipped[pattern]
+            c[0] += 1
+            c[1] += size
+        return True
+
+    def __bool__(self) -> bool: return bool(self.patterns)
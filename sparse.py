@@ -0,0 +1,121 @@
+"""Sparse file support: find data extents and read or write just those.
+
+Holes are found with lseek SEEK_DATA and SEEK_HOLE (Linux, FreeBSD and
+others). A sparse file is stored as its data extents concatenated, plus
+an extent list of [offset, length] pairs (the hole map) to put them back
+with :class:`ExtentWriter`, which leaves holes unwritten.
+"""
+import bisect, errno, os, shutil
+
+def extents(path: str) -> list:
+    """Return [offset, length] data extents of a sparse file, or None.
+
+    None is returned for files without holes (checked cheaply from the
+    allocated block count first) and where holes cannot be detected.
+    """
+    st = os.stat(path)
+    if not hasattr(os, 'SEEK_DATA') or not st.st_size or \
+            getattr(st, 'st_blocks', st.st_size) * 512 >= st.st_size:
+        return None
+    res, pos = [], 0
+    with open(path, 'rb') as f:
+        fd = f.fileno()
+        try:
+            while pos < st.st_size:
+                try: start = os.lseek(fd, pos, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno == errno.ENXIO: break # only a hole left
+                    raise
+                pos = min(os.lseek(fd, start, os.SEEK_HOLE), st.st_size)
+                res.append([start, pos - start])
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.ENOTSUP): return None # no support
+            raise
+    return None if res == [[0, st.st_size]] else res
+
+class ExtentReader(object):
+    """Read-only file object over the data extents of a file, concatenated.
+
+    Args:
+        filename (str): File to read
+        extents (list): [offset, length] pairs, see :func:`extents`
+    """
+    def __init__(self, filename: str, extents: list) -> None:
+        self.fp = open(filename, 'rb')
+        self.extents, self._starts, self.size = extents, [], 0
+        for _,n in extents:
+            self._starts.append(self.size)
+            self.size += n
+        self._pos = 0
+
+    def __enter__(self): return self
+
+    def __exit__(self, type, value, traceback) -> None: self.close()
+
+    def read(self, size: int=-1) -> bytes:
+        if size is None or size < 0: size = self.size - self._pos
+        out = []
+        while size > 0 and self._pos < self.size:
+            i = bisect.bisect_right(self._starts, self._pos) - 1
+            offset, length = self.extents[i]
+            skip = self._pos - self._starts[i]
+            self.fp.seek(offset + skip)
+            data = self.fp.read(min(size, length - skip))
+            if not data: break # file shrunk
+            out.append(data)
+            self._pos += len(data)
+            size -= len(data)
+        return b''.join(out)
+
+    def seek(self, offset: int, whence: int=0) -> int:
+        self._pos = max(0, offset + (0, self._pos, self.size)[whence])
+        return self._pos
+
+    def tell(self) -> int: return self._pos
+
+    def close(self) -> None: self.fp.close()
+
+class ExtentWriter(object):
+    """Write-only file object placing concatenated data back to extents.
+
+    The file is truncated to size on close, so the gaps stay holes.
+
+    Args:
+        filename (str): File to create
+        extents (list): [offset, length] pairs, see :func:`extents`
+        size (int): Final size of the file
+    """
+    def __init__(self, filename: str, extents: list, size: int) -> None:
+        self.fp = open(filename, 'wb')
+        self.extents, self.size = extents, size
+        self._i, self._left = 0, extents[0][1] if extents else 0
+        if extents: self.fp.seek(extents[0][0])
+
+    def __enter__(self): return self
+
+    def __exit__(self, type, value, traceback) -> None: self.close()
+
+    def write(self, data: bytes) -> int:
+        view, n = memoryview(data), len(data)
+        while view:
+            if not self._left: # next extent
+                self._i += 1
+                if self._i >= len(self.extents): raise ValueError('Data beyond extents')
+                self.fp.seek(self.extents[self._i][0])
+                self._left = self.extents[self._i][1]
+            k = min(self._left, len(view))
+            self.fp.write(view[:k])
+            view, self._left = view[k:], self._left - k
+        return n
+
+    def close(self) -> None:
+        if not self.fp.closed: self.fp.truncate(self.size)
+        self.fp.close()
+
+def copy(src: str, dst: str) -> None:
+    """Copy file contents, keeping holes of a sparse source."""
+    ext = extents(src)
+    if not ext: return shutil.copyfile(src, dst)
+    with ExtentReader(src, ext) as fin, \
+            ExtentWriter(dst, ext, os.path.getsize(src)) as fout:
+        shutil.copyfileobj(fin, fout)
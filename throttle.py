@@ -0,0 +1,124 @@
+"""Token bucket bandwidth limiting and adaptive transfer concurrency."""
+import threading, time
+
+def parse_rate(rate: str) -> int:
+    """Convert rate like 500k, 10M or 1G (bytes per second) to int."""
+    return int(float(rate.upper().replace('G', 'e9').replace('M', 'e6')
+        .replace('K', 'e3')))
+
+class TokenBucket(object):
+    """Thread-safe token bucket, rate and burst in bytes (per second).
+
+    Consuming more than is available is allowed, but the caller is put
+    to sleep until the debt would have been accumulated.
+
+    Args:
+        rate (int): Bytes per second
+        burst (int): Bucket size, defaults to one second worth of data
+    """
+    def __init__(self, rate: int, burst: int=None) -> None:
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int) -> None:
+        """Take n tokens, sleeping if bucket runs empty."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                    self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait: time.sleep(wait)
+
+def limiter(rate: object) -> TokenBucket:
+    """Return TokenBucket for a rate (str or int), passthrough a bucket."""
+    if not rate or isinstance(rate, TokenBucket): return rate or None
+    return TokenBucket(parse_rate(rate) if isinstance(rate, str) else rate)
+
+# Process-wide limit shared by all transfers, set with limit_globally()
+global_bucket = None
+
+def limit_globally(rate: object) -> None:
+    """Set (or with None, remove) the process-wide bandwidth limit."""
+    global global_bucket
+    global_bucket = limiter(rate)
+
+class ThrottledFile(object):
+    """File-like wrapper that limits read and write speed.
+
+    All given buckets (and the global one if set) are consumed for each
+    read or written chunk. Other attributes are passed to wrapped object.
+    """
+    def __init__(self, fp, *buckets) -> None:
+        self.fp = fp
+        self.buckets = [b for b in buckets + (global_bucket,) if b]
+
+    def read(self, size: int=-1) -> bytes:
+        data = self.fp.read(size)
+        for b in self.buckets: b.consume(len(data))
+        return data
+
+    def write(self, data: bytes) -> int:
+        for b in self.buckets: b.consume(len(data))
+        return self.fp.write(data)
+
+    def __getattr__(self, name): return getattr(self.fp, name)
+
+class Tuner(object):
+    """Adapt transfer concurrency to observed throughput.
+
+    Simple hill climbing: transfers are gathered into windows of at least
+    minsize bytes, and after each window concurrency keeps changing in
+    the same direction while aggregate throughput (bytes per wall clock
+    second of the window) improves, turning back when it drops. With
+    `fixed` set, concurrency stays constant. Totals are gathered for
+    transfer statistics either way.
+
+    Args:
+        concurrency (int): Initial concurrency (boto3 default is 10)
+        fixed (bool): Do not adapt
+        low (int): Minimum concurrency
+        high (int): Maximum concurrency
+        minsize (int): Bytes to transfer before adapting again
+    """
+    def __init__(self, concurrency: int=10, fixed: bool=False, low: int=1,
+            high: int=32, minsize: int=64*2**20) -> None:
+        self.concurrency = concurrency
+        self.fixed, self.low, self.high, self.minsize = fixed, low, high, minsize
+        self.bytes, self.secs, self.count = 0, 0.0, 0
+        self._step = 2
+        self._last = None
+        self._window = (0, None) # bytes and start time of current window
+        self._lock = threading.Lock()
+
+    def record(self, nbytes: int, secs: float, adapt: bool=True) -> None:
+        """Record a finished transfer and adapt concurrency, unless adapt
+        is False (transfer did not use the tuned concurrency)."""
+        with self._lock:
+            self.bytes += nbytes
+            self.secs += secs
+            self.count += 1
+            if self.fixed or not adapt: return
+            now = time.monotonic()
+            wbytes, wstart = self._window
+            wbytes, wstart = wbytes + nbytes, now - secs if wstart is None else wstart
+            if wbytes < self.minsize or now <= wstart:
+                self._window = (wbytes, wstart)
+                return
+            self._window = (0, None)
+            speed = wbytes / (now - wstart)
+            if self._last is not None and speed < self._last:
+                self._step = -self._step # got worse, go the other way
+            self._last = speed
+            self.concurrency = min(max(self.concurrency + self._step,
+                self.low), self.high)
+
+    def summary(self) -> str:
+        """Return human readable throughput statistics."""
+        speed = self.bytes / self.secs / 2**20 if self.secs else 0
+        return f'{self.count} transfers, {self.bytes/2**20:.1f} MiB in ' + \
+            f'{self.secs:.1f}s ({speed:.2f} MiB/s), concurrency {self.concurrency}'